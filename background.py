@@ -0,0 +1,228 @@
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk
+
+from profiler import PROFILER
+
+# Jobs waiting behind the running one, submitting more is refused until the queue drains
+DEFAULT_MAX_JOBS = 8
+POLL_INTERVAL_MS = 100
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # Unit of work run on the worker thread. func(job) reports progress and checks for
+    # cancellation through the job, it must not touch any Tk widget.
+    def __init__(self, name, func, cancellable=True, on_done=None):
+        self.name = name
+        self.func = func
+        self.cancellable = cancellable
+        self.on_done = on_done
+        self.calls = None
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.warnings = []
+        self.cancel_event = threading.Event()
+        # File loads: the (file_path, file) being opened and whether the app switched to it
+        self.source = None
+        self.installed = False
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        if self.cancellable:
+            self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def report(self, done, total):
+        self.done, self.total = done, total
+
+    def post(self, func, *args):
+        # Run func(*args) on the Tk main loop, e.g. to fill a dropdown before the job is over
+        self.calls.put((func, args))
+
+    def warn(self, message):
+        self.warnings.append(message)
+        print(message)
+
+    def run(self):
+        try:
+            self.check_cancelled()
+            with PROFILER.span(self.name):
+                self.result = self.func(self)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+
+
+class BackgroundWorker:
+    # Single worker thread fed by a bounded queue, finished jobs are handed back to the
+    # Tk main loop through another queue
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS):
+        self.jobs = queue.Queue(maxsize=max_jobs)
+        self.finished = queue.Queue()
+        self.calls = queue.Queue()
+        self.current = None
+        self.pending = []
+        # Jobs put in the queue and jobs run, [(jobs to wait for, func)] for after_queued
+        self.submitted = 0
+        self.completed = 0
+        self.deferred = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, func, cancellable=True, block=False, on_done=None):
+        # Raises queue.Full when the queue is full and block is False
+        job = Job(name, func, cancellable, on_done)
+        job.calls = self.calls
+        with self.lock:
+            self.pending.append(job)
+            self.submitted += 1
+        try:
+            self.jobs.put(job, block=block)
+        except queue.Full:
+            with self.lock:
+                self.pending.remove(job)
+                self.submitted -= 1
+            raise
+        return job
+
+    def after_queued(self, func):
+        # func() once the jobs queued so far are done, e.g. closing a file they read. Never
+        # waits for room in the queue: it runs right away when the worker is idle, on the
+        # worker thread after the last of those jobs otherwise.
+        with self.lock:
+            if self.current is not None or self.pending:
+                self.deferred.append((self.submitted, func))
+                return
+        func()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            with self.lock:
+                self.pending.remove(job)
+                self.current = job
+            job.run()
+            with self.lock:
+                self.current = None
+                self.completed += 1
+                ready = [func for count, func in self.deferred if count <= self.completed]
+                self.deferred = [item for item in self.deferred if item[0] > self.completed]
+            for func in ready:
+                try:
+                    func()
+                except Exception as e:
+                    print(f"Error after {job.name}: {e}")
+            self.finished.put(job)
+
+    def cancel_all(self):
+        with self.lock:
+            jobs = self.pending + ([self.current] if self.current else [])
+        for job in jobs:
+            job.cancel()
+
+    def busy(self):
+        with self.lock:
+            return self.current is not None or bool(self.pending)
+
+
+class JobPanel:
+    # Progress bar and cancel button for the export worker and the file loader, polled with root.after
+    def __init__(self, root, info_label, max_jobs=DEFAULT_MAX_JOBS):
+        self.root = root
+        self.info_label = info_label
+        self.worker = BackgroundWorker(max_jobs)
+        # Loads have their own thread so they never wait behind exports
+        self.loader = BackgroundWorker(max_jobs=0)
+
+        frame = tk.Frame(root)
+        frame.pack()
+        self.progress = ttk.Progressbar(frame, mode="determinate", length=300, maximum=100)
+        self.progress.pack(side=tk.LEFT, padx=5)
+        self.status_label = tk.Label(frame, text="")
+        self.status_label.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = tk.Button(frame, text="Cancel", command=self.cancel)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def submit(self, name, func, cancellable=True, block=False):
+        try:
+            job = self.worker.submit(name, func, cancellable, block)
+        except queue.Full:
+            self.info_label.config(text=f"Too many exports queued, {name} was not started.")
+            return None
+        self.info_label.config(text=f"{name} queued.")
+        return job
+
+    def load(self, name, func, on_done):
+        # A new load replaces the one in progress
+        self.loader.cancel_all()
+        return self.loader.submit(name, func, on_done=on_done)
+
+    def cancel(self):
+        # Cancel stops a file that is being loaded first, the exports otherwise
+        if self.loader.busy():
+            self.loader.cancel_all()
+            self.info_label.config(text="Cancelling file loading...")
+        else:
+            self.worker.cancel_all()
+            self.info_label.config(text="Cancelling queued exports...")
+
+    def report(self, job):
+        if job.on_done is not None:
+            job.on_done(job)
+        elif job.cancelled:
+            self.info_label.config(text=f"{job.name} cancelled.")
+        elif job.error is not None:
+            self.info_label.config(text=f"{job.name} failed: {job.error}")
+        elif job.warnings:
+            self.info_label.config(text=job.warnings[-1])
+        elif job.result:
+            self.info_label.config(text=job.result)
+
+    def poll(self):
+        # Rescheduled first so a failing callback does not stop the polling
+        self.root.after(POLL_INTERVAL_MS, self.poll)
+        for worker in (self.loader, self.worker):
+            while True:
+                try:
+                    func, args = worker.calls.get_nowait()
+                except queue.Empty:
+                    break
+                func(*args)
+            while True:
+                try:
+                    job = worker.finished.get_nowait()
+                except queue.Empty:
+                    break
+                self.report(job)
+
+        current = self.loader.current or self.worker.current
+        if current is not None:
+            status = current.name
+            if current.total:
+                self.progress["value"] = 100 * current.done / current.total
+                status += f" ({current.done}/{current.total})"
+            queued = len(self.worker.pending)
+            if queued:
+                status += f", {queued} exports queued"
+            self.status_label.config(text=status)
+        elif not self.worker.busy():
+            self.progress["value"] = 0
+            # With profiling on, the idle status bar shows where the last operation spent its time
+            self.status_label.config(text=PROFILER.summary())
@@ -0,0 +1,119 @@
+"""Headless version of the "Save All" button.
+
+Extracts the quadrants of every channel of every file and writes them to
+`{directory}/quadrants` like `save_all_quadrants` in the GUI, with the tile
+origins in a coordinates file next to them.
+Other tile sizes, strides and edge policies build datasets from the same scans:
+
+    python batch_quadrants.py /data/scans "/data/more/*.spm" --workers 16
+    python batch_quadrants.py /data/scans --size 64 128 256 --overlap 32 --edge reflect
+"""
+import argparse
+import glob
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from readers import NUMPY_EXTENSIONS, TDMS_EXTENSIONS, open_scan
+from tiling import EDGE_POLICIES, TILE_SIZE, save_coordinates_file, save_tiles
+
+# Scans found in directories and glob patterns: TDMS, and Bruker files named .spm or with the
+# scan number as extension (.001, .002...). Anything else would be opened as a Bruker file.
+SCAN_EXTENSIONS = TDMS_EXTENSIONS + (".spm",)
+BRUKER_NUMBERED_EXTENSION = re.compile(r"\.\d{3}$")
+
+
+def is_scan_file(path):
+    path = path.lower()
+    return path.endswith(SCAN_EXTENSIONS) or BRUKER_NUMBERED_EXTENSION.search(path) is not None
+
+
+def find_files(inputs):
+    files = []
+    for item in inputs:
+        if os.path.isfile(item):
+            # Named on the command line: .npy/.npz arrays too, they are skipped in directories
+            # and patterns where they are the apps' own exports
+            if is_scan_file(item) or item.lower().endswith(NUMPY_EXTENSIONS):
+                files.append(item)
+            continue
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in sorted(os.listdir(item))]
+        else:
+            candidates = sorted(glob.glob(item))
+        for path in candidates:
+            if os.path.isfile(path) and is_scan_file(path):
+                files.append(path)
+    # Keep the order but drop files matched by several inputs
+    return list(dict.fromkeys(files))
+
+
+def iter_channel_images(file_path, scan_dir):
+    # Only the requested scan direction of TDMS files is decoded, other formats ignore it
+    with open_scan(file_path) as scan:
+        yield from scan.iter_channels(scan_dir)
+
+
+def process_file(file_path, scan_dir, sizes, stride=None, overlap=0, edge="drop"):
+    # Every channel is read once and cut at all the tile sizes. A single size writes to
+    # quadrants/ like "Save All", several sizes to quadrants/<size>px/. The tile origins go to a
+    # coordinates file next to the tiles: the one next to the scan holds the areas picked in the
+    # GUI ("Save Coordinates") and is never overwritten.
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    out_dirs = {size: f"{directory}/quadrants" if len(sizes) == 1 else f"{directory}/quadrants/{size}px"
+                for size in sizes}
+    for out_dir in out_dirs.values():
+        os.makedirs(out_dir, exist_ok=True)
+    n_areas = 0
+    coords = {}
+    for channel, channel_image in iter_channel_images(file_path, scan_dir):
+        for size in sizes:
+            coords[size] = save_tiles(out_dirs[size], file_name, channel, channel_image, size, stride, overlap, edge)
+            n_areas += len(coords[size])
+    for size, size_coords in coords.items():
+        save_coordinates_file(out_dirs[size], file_name, size_coords)
+    return n_areas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract quadrants for every channel of every scan.")
+    parser.add_argument("inputs", nargs="+", help="Directories, files or glob patterns")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--size", type=int, nargs="+", default=[TILE_SIZE], help="Tile sizes (px), e.g. 64 128 256")
+    parser.add_argument("--stride", type=int, help="Distance between tiles (px), the tile size by default")
+    parser.add_argument("--overlap", type=int, default=0, help="Overlap between tiles (px), ignored with --stride")
+    parser.add_argument("--edge", choices=EDGE_POLICIES, default="drop",
+                        help="Tiles running past the image: dropped, zero padded or reflected")
+    parser.add_argument("--scan-dir", default="Retrace (Frame 2)", help="TDMS group to extract")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.inputs)
+    if not files:
+        parser.error("no input files found")
+
+    start = time.perf_counter()
+    n_done = n_failed = n_areas = n_bytes = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process_file, path, args.scan_dir, args.size, args.stride, args.overlap, args.edge): path for path in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                n_areas += future.result()
+                n_bytes += os.path.getsize(path)
+                n_done += 1
+                print(f"[{n_done + n_failed}/{len(files)}] {path}")
+            except Exception as e:
+                n_failed += 1
+                print(f"[{n_done + n_failed}/{len(files)}] Error processing {path}: {e}")
+    elapsed = time.perf_counter() - start
+
+    print(f"Processed {n_done} files ({n_failed} failed), {n_areas} areas, "
+          f"{n_bytes / 1e6:.1f} MB in {elapsed:.2f} s")
+    print(f"Throughput: {n_done / elapsed:.2f} files/s, {n_bytes / 1e6 / elapsed:.2f} MB/s "
+          f"with {args.workers} workers")
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,124 @@
+"""Re-export the areas of saved coordinates files.
+
+Reads `{file_name}_selected_areas_coordinates.txt` next to every scan ("Save
+Coordinates" in the GUI, top left corners of the areas) and extracts every area
+from every channel of every scan direction again, in any export format. Each
+scan is read once, files are spread across all cores:
+
+    python batch_replay.py /data/scans --size 256 --format npy
+    python batch_replay.py "/data/*.spm" --size 64 --format parquet --channels Height Adhesion
+"""
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from batch_quadrants import find_files
+from exporters import EXPORT_FORMATS, write_columns, write_stack
+from readers import open_scan
+from tiling import TILE_SIZE, read_coordinates
+
+# npy: one file per area and channel like "Save Selected Area", stack: one (C, H, W) file per
+# area, table formats: one table per area with a column per channel
+REPLAY_FORMATS = ["npy", "stack"] + EXPORT_FORMATS
+
+
+def coordinates_path(file_path):
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    return f"{directory}/{file_name}_selected_areas_coordinates.txt"
+
+
+def scan_dir_tag(scan_dir):
+    # "Retrace (Frame 2)" -> "_Retrace_Frame_2", nothing for formats without scan directions
+    if scan_dir is None:
+        return ""
+    return "_" + re.sub(r"[^\w-]+", "_", scan_dir).strip("_")
+
+
+def replay_file(file_path, size, export_format="npy", subdir="replay", scan_dirs=None, channels=None,
+                class_label=None):
+    # Every channel of every scan direction is read once and all the areas are cut from it, areas
+    # out of the image are skipped like in the GUI. Returns the number of areas written.
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    coords = read_coordinates(coordinates_path(file_path))
+    out_dir = f"{directory}/{subdir}"
+    os.makedirs(out_dir, exist_ok=True)
+    n_areas = 0
+    with open_scan(file_path) as scan:
+        for scan_dir in scan.scan_dirs:
+            if scan_dirs and scan_dir is not None and scan_dir not in scan_dirs:
+                continue
+            # {area index: {channel: area}}, areas are small enough to keep until all channels are read
+            areas = {i: {} for i in range(len(coords))}
+            for channel, channel_image in scan.iter_channels(scan_dir):
+                if channels and channel not in channels:
+                    continue
+                for i, (x, y) in enumerate(coords):
+                    x_start, y_start = max(x, 0), max(y, 0)
+                    area = channel_image[y_start:y_start + size, x_start:x_start + size]
+                    if area.shape == (size, size):
+                        areas[i][channel] = np.array(area)
+            tag = scan_dir_tag(scan_dir)
+            for i, channel_areas in areas.items():
+                if not channel_areas:
+                    continue
+                # Numbered from 1 like the areas saved in the GUI
+                file_base = f"{out_dir}/{file_name}_AREA{i + 1}{tag}"
+                if export_format == "npy":
+                    for channel, area in channel_areas.items():
+                        np.save(f"{file_base}_{channel}_selected_area.npy", area)
+                elif export_format == "stack":
+                    write_stack(f"{file_base}_selected_area_stack.npy", list(channel_areas),
+                                channel_areas.values())
+                else:
+                    if class_label is not None:
+                        file_base = f"{file_base}_CLASS{class_label}"
+                    write_columns(f"{file_base}_selected_area", list(channel_areas),
+                                  [area.ravel() for area in channel_areas.values()], export_format, class_label)
+                n_areas += 1
+    return n_areas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-extract the areas of saved coordinates files.")
+    parser.add_argument("inputs", nargs="+", help="Directories, files or glob patterns")
+    parser.add_argument("--size", type=int, default=TILE_SIZE, help="Area size (px) the coordinates were saved with")
+    parser.add_argument("--format", choices=REPLAY_FORMATS, default="npy", help="Export format")
+    parser.add_argument("--subdir", default="replay", help="Output directory, next to each scan")
+    parser.add_argument("--scan-dir", nargs="+", help="TDMS scan directions to extract, all of them by default")
+    parser.add_argument("--channels", nargs="+", help="Channels to extract, all of them by default")
+    parser.add_argument("--class-label", help="Class column of the table formats, as in main_poly*.py")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    args = parser.parse_args(argv)
+
+    # Only scans with a coordinates file
+    files = [path for path in find_files(args.inputs) if os.path.exists(coordinates_path(path))]
+    if not files:
+        parser.error("no input files with a coordinates file found")
+
+    start = time.perf_counter()
+    n_done = n_failed = n_areas = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(replay_file, path, args.size, args.format, args.subdir, args.scan_dir, args.channels,
+                               args.class_label): path for path in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                n_areas += future.result()
+                n_done += 1
+                print(f"[{n_done + n_failed}/{len(files)}] {path}")
+            except Exception as e:
+                n_failed += 1
+                print(f"[{n_done + n_failed}/{len(files)}] Error processing {path}: {e}")
+    elapsed = time.perf_counter() - start
+
+    print(f"Replayed {n_done} files ({n_failed} failed), {n_areas} areas in {elapsed:.2f} s "
+          f"({n_done / elapsed:.2f} files/s with {args.workers} workers)")
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,98 @@
+"""Surface parameters of many regions at once.
+
+Runs `extract_parameters` on every tile and/or every stored rectangle
+(`{file_name}_selected_areas_coordinates.txt` next to the scan) of every
+channel of every file, on a process pool, and writes one table with a row per
+region and a column per parameter:
+
+    python batch_surfparams.py /data/scans --size 128 --workers 16
+    python batch_surfparams.py "/data/*.spm" --regions coordinates --size 20 --channels Height
+"""
+import argparse
+import os
+import time
+
+from batch_quadrants import find_files
+from exporters import DEFAULT_TABLE_FORMAT, EXTENSIONS, TableWriter
+from readers import open_scan
+from result_cache import DEFAULT_RESULT_CACHE_BYTES, ResultCache
+from surfparams import DEFAULT_DIMENSIONS_UM, compute_regions, coordinate_regions, pixel_size, tile_regions
+from tiling import EDGE_POLICIES, TILE_SIZE, read_coordinates
+
+REGION_KINDS = ["tiles", "coordinates"]
+
+
+def iter_regions(files, args):
+    # (region, area, dx) for the pool, one channel image in memory at a time
+    for file_path in files:
+        directory, file_name = os.path.split(os.path.abspath(file_path))
+        coords_path = f"{directory}/{file_name}_selected_areas_coordinates.txt"
+        coords = read_coordinates(coords_path) if os.path.exists(coords_path) else []
+        try:
+            with open_scan(file_path) as scan:
+                for channel, channel_image in scan.iter_channels(args.scan_dir):
+                    if args.channels and channel not in args.channels:
+                        continue
+                    dx = pixel_size(args.dimensions, channel_image.shape)
+                    region = {"file": file_name, "channel": channel}
+                    if "tiles" in args.regions:
+                        for item in tile_regions(channel_image, dict(region, kind="tile"), args.size,
+                                                 args.stride, args.overlap, args.edge):
+                            yield item + (dx,)
+                    if "coordinates" in args.regions:
+                        for item in coordinate_regions(channel_image, dict(region, kind="rectangle"), coords,
+                                                       args.size):
+                            yield item + (dx,)
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute surface parameters for many regions of many scans.")
+    parser.add_argument("inputs", nargs="+", help="Directories, files or glob patterns")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--regions", nargs="+", choices=REGION_KINDS, default=["tiles"],
+                        help="Tiles of the whole image and/or the rectangles of the coordinates files")
+    parser.add_argument("--size", type=int, default=TILE_SIZE, help="Region size (px)")
+    parser.add_argument("--stride", type=int, help="Distance between tiles (px), the tile size by default")
+    parser.add_argument("--overlap", type=int, default=0, help="Overlap between tiles (px), ignored with --stride")
+    parser.add_argument("--edge", choices=EDGE_POLICIES, default="drop",
+                        help="Tiles running past the image: dropped, zero padded or reflected")
+    parser.add_argument("--channels", nargs="+", help="Channels to process, all of them by default")
+    parser.add_argument("--scan-dir", default="Retrace (Frame 2)", help="TDMS group to read")
+    parser.add_argument("--dimensions", type=float, default=DEFAULT_DIMENSIONS_UM,
+                        help="Physical width of the scans (um)")
+    parser.add_argument("--format", choices=list(EXTENSIONS), default=DEFAULT_TABLE_FORMAT, help="Table format")
+    parser.add_argument("--output", default="surface_parameters", help="Output table, without extension")
+    parser.add_argument("--cache-dir", help="Result cache directory, shared with the GUI by default")
+    parser.add_argument("--cache-mb", type=float, default=DEFAULT_RESULT_CACHE_BYTES / 1024 ** 2,
+                        help="Result cache size (MB), least recently used results are evicted past it")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute every region")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.inputs)
+    if not files:
+        parser.error("no input files found")
+
+    def progress(n_done, n_failed):
+        if (n_done + n_failed) % 100 == 0:
+            print(f"{n_done + n_failed} regions, {n_done / (time.perf_counter() - start):.1f} regions/s")
+
+    cache = None if args.no_cache else ResultCache(args.cache_dir, int(args.cache_mb * 1024 ** 2))
+    start = time.perf_counter()
+    with TableWriter(args.output, args.format) as writer:
+        n_done, n_failed, elapsed = compute_regions(iter_regions(files, args), writer, args.workers,
+                                                    on_row=progress, cache=cache)
+
+    print(f"Computed {n_done} regions ({n_failed} failed) from {len(files)} files in {elapsed:.2f} s")
+    print(f"Throughput: {n_done / elapsed:.2f} regions/s with {args.workers} workers")
+    if cache is not None:
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses ({cache.hit_rate:.0%}), "
+              f"{len(cache)} results, {cache.current_bytes / 1e6:.1f} MB in {cache.directory}")
+    if writer.n_rows:
+        print(f"Saved {writer.file_path}")
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
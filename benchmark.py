@@ -0,0 +1,398 @@
+"""Headless benchmark of the image selector apps.
+
+Generates synthetic TDMS and Bruker scans, drives the real app methods on the
+Agg backend (load, channel switch, extract_area, save_area, save_all_quadrants,
+save_full) and writes the timings as JSON so two commits can be compared.
+
+    python benchmark.py --size 1024 --channels 8 --output before.json
+    python benchmark.py --size 1024 --channels 8 --output after.json --compare before.json
+    python benchmark.py --size 512x256  # rectangular scans, rows x columns
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import queue
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+from nptdms import ChannelObject, TdmsWriter
+
+from background import Job
+
+TDMS_APPS = ["main", "main_mik", "main_poly", "main_surparam"]
+BRUKER_APPS = ["main_mik_bruker", "main_poly_bruker"]
+OPERATIONS = ["load", "switch_channel", "extract_area", "save_area", "save_all_quadrants", "save_full",
+              "compute_tile_stats"]
+SCAN_DIRS = ["Retrace (Frame 2)", "Trace (Frame 1)"]
+BRUKER_CHANNELS = ["Height Sensor", "Peak Force Error", "DMTModulus", "LogDMT", "Adhesion",
+                   "Deformation", "Dissipation", "Height"]
+# Median slowdown reported as a regression by --compare
+REGRESSION_RATIO = 1.2
+
+
+def channel_names(n_channels):
+    names = BRUKER_CHANNELS[:n_channels]
+    return names + [f"Channel{i}" for i in range(len(names), n_channels)]
+
+
+def parse_size(text):
+    # "512" for square scans, "512x256" for rows x columns
+    rows, _, cols = text.lower().partition("x")
+    return int(rows), int(cols or rows)
+
+
+def synthetic_image(shape, seed):
+    # Smooth surface plus noise, so percentiles and stats see realistic data
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]] / max(shape)
+    return np.sin(6 * x) * np.cos(4 * y) + 0.1 * rng.standard_normal(shape)
+
+
+def make_tdms(file_path, shape=(512, 512), n_channels=4):
+    # Same layout as the scans update_image reads: one group per scan direction, flat channels.
+    # Rectangular scans get their size as channel properties, square ones have none.
+    properties = {} if shape[0] == shape[1] else {"Number of lines": shape[0], "Samps/line": shape[1]}
+    with TdmsWriter(file_path) as writer:
+        for d, scan_dir in enumerate(SCAN_DIRS):
+            writer.write_segment([
+                ChannelObject(scan_dir, name, synthetic_image(shape, 10 * d + i).ravel(), properties)
+                for i, name in enumerate(channel_names(n_channels))
+            ])
+    return file_path
+
+
+def bruker_header(shape, names, offsets):
+    data_length = shape[0] * shape[1] * 4
+    lines = [
+        "\\*File list",
+        "\\Version: 0x09400202",
+        "\\*Scanner list",
+        "\\@Sens. Zsens: V 10 nm/V",
+    ]
+    for name, offset in zip(names, offsets):
+        lines += [
+            "\\*Ciao image list",
+            f"\\Data offset: {offset}",
+            f"\\Data length: {data_length}",
+            "\\Bytes/pixel: 4",
+            # The images are written row-major: "Number of lines" rows of "Samps/line" values
+            f"\\Number of lines: {shape[0]}",
+            f"\\Samps/line: {shape[1]}",
+            "\\Scan Size: 10 10 ~m",
+            "\\Aspect Ratio: 1:1",
+            "\\Line Direction: Trace",
+            f"\\@2:Image Data: S [{name.replace(' ', '')}] \"{name}\"",
+            "\\@2:Z scale: V [Sens. Zsens] (0.000375 V/LSB) 24.57 V",
+            "\\@2:Z offset: V [Sens. Zsens] (0.000375 V/LSB) 0 V",
+        ]
+    lines.append("\\*File list end")
+    return ("\r\n".join(lines) + "\r\n").encode("latin1")
+
+
+def make_bruker(file_path, shape=(512, 512), n_channels=4):
+    # Minimal Nanoscope file: a text header pySPM.Bruker parses, then int32 images
+    names = channel_names(n_channels)
+    header_size = len(bruker_header(shape, names, [0] * len(names))) + 64 * len(names)
+    header_size = -(-header_size // 4096) * 4096
+    offsets = [header_size + i * shape[0] * shape[1] * 4 for i in range(len(names))]
+    header = bruker_header(shape, names, offsets)
+    with open(file_path, "wb") as file:
+        file.write(header.ljust(header_size, b"\x1a"))
+        for i in range(len(names)):
+            image = synthetic_image(shape, i)
+            file.write((image / np.abs(image).max() * 2 ** 30).astype("<i4").tobytes())
+    return file_path
+
+
+class HeadlessWidget:
+    # Stands in for the Tk widgets, keeps what the apps read back (text, values, entries)
+    def __init__(self, *args, **kwargs):
+        self.options = dict(kwargs)
+        self.text = ""
+
+    def __setitem__(self, key, value):
+        self.options[key] = value
+
+    def __getitem__(self, key):
+        return self.options[key]
+
+    def pack(self, *args, **kwargs):
+        pass
+
+    def bind(self, *args, **kwargs):
+        pass
+
+    def config(self, **kwargs):
+        self.options.update(kwargs)
+
+    configure = config
+
+    def insert(self, index, text):
+        self.text = self.text + str(text)
+
+    def delete(self, first, last=None):
+        self.text = ""
+
+    def get(self):
+        return self.text
+
+
+class HeadlessVar:
+    def __init__(self, master=None, value=""):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+    def trace_add(self, mode, callback):
+        pass
+
+
+class HeadlessRoot(HeadlessWidget):
+    def title(self, *args):
+        pass
+
+    def after(self, *args):
+        pass
+
+
+class HeadlessTk:
+    LEFT = "left"
+    Tk = HeadlessRoot
+    Frame = Button = Label = Entry = Scrollbar = HeadlessWidget
+    StringVar = DoubleVar = IntVar = HeadlessVar
+
+
+class HeadlessTtk:
+    Combobox = Progressbar = HeadlessWidget
+
+
+class HeadlessCanvas(FigureCanvasAgg):
+    def __init__(self, figure, master=None):
+        super().__init__(figure)
+
+    def get_tk_widget(self):
+        return HeadlessWidget()
+
+
+class HeadlessDialogs:
+    # Every file and directory dialog answers with the benchmark paths
+    def __init__(self, open_path, directory):
+        self.open_path = open_path
+        self.directory = directory
+
+    def askopenfilename(self, **kwargs):
+        return self.open_path
+
+    def askdirectory(self, **kwargs):
+        return self.directory
+
+    def asksaveasfilename(self, **kwargs):
+        return os.path.join(self.directory, "benchmark" + kwargs.get("defaultextension", ""))
+
+
+class HeadlessJobs:
+    # Replaces the JobPanel: jobs are queued like on the worker threads and run_pending runs
+    # them on the calling thread, in the order the Tk poll loop would report them
+    def __init__(self):
+        self.worker = self
+        self.pending = []
+
+    def submit(self, name, func, cancellable=True, block=False, on_done=None):
+        job = Job(name, func, cancellable, on_done)
+        job.calls = queue.Queue()
+        self.pending.append(job)
+        return job
+
+    def after_queued(self, func):
+        self.submit(func.__name__, lambda job: func(), cancellable=False)
+
+    def load(self, name, func, on_done):
+        return self.submit(name, func, on_done=on_done)
+
+    def run_pending(self):
+        while self.pending:
+            job = self.pending.pop(0)
+            job.run()
+            while not job.calls.empty():
+                func, args = job.calls.get()
+                func(*args)
+            if job.on_done is not None:
+                job.on_done(job)
+            # A broken operation must not look fast
+            if job.error is not None:
+                raise job.error
+            if job.warnings:
+                raise RuntimeError(f"{job.name}: {job.warnings[-1]}")
+
+
+def make_app(module_name, open_path, directory):
+    module = importlib.import_module(module_name)
+    module.tk = HeadlessTk
+    module.ttk = HeadlessTtk
+    module.FigureCanvasTkAgg = HeadlessCanvas
+    module.filedialog = HeadlessDialogs(open_path, directory)
+    module.JobPanel = lambda root, info_label: HeadlessJobs()
+    return module.ImageSelectorApp(HeadlessRoot())
+
+
+def run_app(app, operation):
+    if operation == "load":
+        app.load_data()
+    elif operation == "switch_channel":
+        channels = list(app.channel_dropdown["values"])
+        app.channel_var.set(channels[(channels.index(app.channel_var.get()) + 1) % len(channels)])
+        app.update_image()
+    elif operation == "extract_area":
+        h, w = app.image_data.shape
+        app.rect_size = min(256, h, w)
+        app.start_x, app.start_y = w // 2, h // 2
+        app.extract_area()
+    else:
+        getattr(app, operation)()
+    app.jobs.run_pending()
+
+
+def time_operation(app, operation):
+    # App prints are part of the cost but not of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run_app(app, operation)
+        return time.perf_counter() - start
+
+
+def benchmark_app(module_name, file_path, out_dir, repeats):
+    app = make_app(module_name, file_path, out_dir)
+    operations = [op for op in OPERATIONS if op in ("load", "switch_channel") or hasattr(app, op)]
+    times = {op: [] for op in operations}
+    for _ in range(repeats):
+        # Every round starts from a fresh load, so the channel switch decodes a new channel
+        for operation in operations:
+            times[operation].append(time_operation(app, operation))
+        app.close_file()
+        app.jobs.run_pending()
+    return times
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(app, file_format, operation, times, size, n_channels):
+    return {
+        "app": app,
+        "format": file_format,
+        "operation": operation,
+        "size": list(size),
+        "channels": n_channels,
+        "repeats": len(times),
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "times_s": times,
+    }
+
+
+def compare(results, baseline):
+    previous = {(r["app"], r["format"], r["operation"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline['meta'].get('commit')}:")
+    for result in results:
+        old = previous.get((result["app"], result["format"], result["operation"]))
+        if old is None:
+            continue
+        ratio = result["median_s"] / old["median_s"] if old["median_s"] else float("inf")
+        flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+        regressions += bool(flag)
+        print(f"{result['app']:>18} {result['operation']:>18}: {old['median_s'] * 1000:9.1f} ms -> "
+              f"{result['median_s'] * 1000:9.1f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the app operations on synthetic scans.")
+    parser.add_argument("--apps", nargs="+", default=TDMS_APPS + BRUKER_APPS, help="App modules to benchmark")
+    parser.add_argument("--size", type=parse_size, default="512", help="Scan size (px), 512 or rows x columns like 512x256")
+    parser.add_argument("--channels", type=int, default=4, help="Channels per scan")
+    parser.add_argument("--repeats", type=int, default=3, help="Rounds per app")
+    parser.add_argument("--output", help="JSON file for the results, printed to stdout otherwise")
+    parser.add_argument("--compare", help="Results of a previous run to compare the medians with")
+    parser.add_argument("--workdir", help="Directory for the fixtures and exports, a temporary one otherwise")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="selector_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    fixtures = {
+        "tdms": make_tdms(os.path.join(workdir, "synthetic.tdms"), args.size, args.channels),
+        "bruker": make_bruker(os.path.join(workdir, "synthetic.spm"), args.size, args.channels),
+    }
+
+    results = []
+    try:
+        for app in args.apps:
+            file_format = "bruker" if app in BRUKER_APPS else "tdms"
+            out_dir = os.path.join(workdir, app)
+            os.makedirs(os.path.join(out_dir, "quadrants"), exist_ok=True)
+            try:
+                times = benchmark_app(app, fixtures[file_format], out_dir, args.repeats)
+            except ImportError as e:
+                # e.g. main_surparam needs dr_pnas
+                print(f"{app:>18} skipped: {e}", file=sys.stderr)
+                continue
+            for operation, op_times in times.items():
+                result = summarize(app, file_format, operation, op_times, args.size, args.channels)
+                results.append(result)
+                print(f"{app:>18} {operation:>18}: median {result['median_s'] * 1000:9.1f} ms, "
+                      f"min {result['min_s'] * 1000:9.1f} ms", file=sys.stderr)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(),
+            "size": list(args.size),
+            "channels": args.channels,
+            "repeats": args.repeats,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(results, json.load(file)):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from profiler import PROFILER
+
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+# Opt-in on-disk store of decoded channels, shared by every app instance and session:
+#   SELECTOR_CHANNEL_STORE=~/.cache/image_selector/channels python main.py
+STORE_ENV = "SELECTOR_CHANNEL_STORE"
+STORE_BYTES_ENV = "SELECTOR_CHANNEL_STORE_MB"
+DEFAULT_STORE_BYTES = 4 * 1024 ** 3
+
+
+class ChannelStore:
+    # Decoded channels saved once as .npy files and reopened memory-mapped, so the next session
+    # (or another app showing the same scan) reads them from the page cache instead of decoding.
+    # Entries are named after the source path, then its size and modification time, then the
+    # channel: a modified source gets new entries and its old ones are deleted. The least
+    # recently used entries are deleted past max_bytes.
+    def __init__(self, directory, max_bytes=DEFAULT_STORE_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizes = OrderedDict()
+        self.lock = threading.RLock()
+        if os.path.isdir(self.directory):
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            for _, name, size in sorted(entries):
+                self._sizes[name] = size
+                self.current_bytes += size
+            # The budget may have been lowered since the last session
+            self.trim()
+
+    @staticmethod
+    def entry_name(file_path, scan_dir, channel):
+        # (name, prefix shared by all the versions of the source)
+        stat = os.stat(file_path)
+        source = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+        version = hashlib.sha1(f"{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:8]
+        channel_id = hashlib.sha1(f"{scan_dir}|{channel}".encode()).hexdigest()[:16]
+        return f"{source}_{version}_{channel_id}.npy", f"{source}_"
+
+    def get(self, key, load):
+        # key is the ChannelCache key (file path, scan direction, channel)
+        try:
+            name, source = self.entry_name(*key)
+        except OSError:
+            return load()
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            try:
+                image = np.load(path, mmap_mode="r")
+                os.utime(path)
+                if name in self._sizes:
+                    self._sizes.move_to_end(name)
+                else:
+                    # Written by another app since this one started
+                    self._sizes[name] = os.path.getsize(path)
+                    self.current_bytes += self._sizes[name]
+                self.hits += 1
+                return image
+            except (OSError, ValueError):
+                self.misses += 1
+        # Decoded without the lock, ChannelCache already serializes the loads of a file
+        image = load()
+        # Memory-mapped inputs are already what the store would give back
+        if isinstance(image, np.memmap):
+            return image
+        try:
+            self.put(name, source, image)
+            return np.load(path, mmap_mode="r")
+        except OSError:
+            return image
+
+    def put(self, name, source, image):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # Entries of previous versions of the source file
+            version = name[:name.index("_", len(source)) + 1]
+            for stale in [entry for entry in self._sizes if entry.startswith(source) and not entry.startswith(version)]:
+                self.remove(stale)
+            path = os.path.join(self.directory, name)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with PROFILER.span("write_store", image.nbytes):
+                with open(temp_path, "wb") as file:
+                    np.save(file, image)
+                os.replace(temp_path, path)
+            if name in self._sizes:
+                self.current_bytes -= self._sizes.pop(name)
+            self._sizes[name] = os.path.getsize(path)
+            self.current_bytes += self._sizes[name]
+            self.trim()
+
+    def trim(self):
+        # The entry written last stays even if it is bigger than the whole budget
+        with self.lock:
+            while self.current_bytes > self.max_bytes and len(self._sizes) > 1:
+                self.remove(next(iter(self._sizes)))
+
+    def remove(self, name):
+        with self.lock:
+            self.current_bytes -= self._sizes.pop(name, 0)
+            try:
+                # Apps still mapping it keep their pages until they let go of the array
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def store_from_env():
+    directory = os.environ.get(STORE_ENV)
+    if not directory:
+        return None
+    max_mb = os.environ.get(STORE_BYTES_ENV)
+    return ChannelStore(directory, int(float(max_mb) * 1024 ** 2) if max_mb else DEFAULT_STORE_BYTES)
+
+
+CHANNEL_STORE = store_from_env()
+
+
+class ChannelCache:
+    # LRU cache of decoded channel images keyed by (file, scan direction, channel).
+    # Display and export share it, so a channel is decoded once as long as it fits in the budget.
+    # Background exports use it too: loads from the same file are serialized, which keeps a
+    # single open TDMS file from being read by two threads at once. The cache lock is only held
+    # around the dict, so hits are never held up by a decode. Misses go through the on-disk
+    # store when one is configured.
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, store=CHANNEL_STORE):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self.lock = threading.RLock()
+        # {file path: lock held while one of its channels is decoded}
+        self._load_locks = {}
+
+    def __contains__(self, key):
+        return key in self._images
+
+    def __len__(self):
+        return len(self._images)
+
+    def lookup(self, key):
+        # The cached image or None, counted as a hit
+        with self.lock:
+            if key not in self._images:
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return self._images[key]
+
+    def load_lock(self, file_path):
+        with self.lock:
+            return self._load_locks.setdefault(file_path, threading.Lock())
+
+    def read(self, key, load):
+        # The cached image, or load() without caching it: one pass over every channel (full
+        # image exports) would otherwise keep them all and evict the ones being looked at
+        image = self.lookup(key)
+        if image is not None:
+            return image
+        with self.load_lock(key[0]):
+            with PROFILER.span("decode", channel=str(key[-1])) as span:
+                image = load()
+                span.add_bytes(image.nbytes)
+            return image
+
+    def get(self, key, load):
+        image = self.lookup(key)
+        if image is not None:
+            return image
+        with self.load_lock(key[0]):
+            # Another thread may have decoded it while this one waited
+            image = self.lookup(key)
+            if image is not None:
+                return image
+            with self.lock:
+                self.misses += 1
+            with PROFILER.span("decode", channel=str(key[-1])) as span:
+                image = load() if self.store is None else self.store.get(key, load)
+                span.add_bytes(image.nbytes)
+            self.put(key, image)
+            return image
+
+    @staticmethod
+    def size(image):
+        # Memory-mapped channels (.npy inputs) live in the page cache, not in the budget
+        return 0 if isinstance(image, np.memmap) else image.nbytes
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self._images:
+                self.current_bytes -= self.size(self._images.pop(key))
+            # An image bigger than the whole budget would only flush everything else
+            if self.size(image) > self.max_bytes:
+                return
+            self._images[key] = image
+            self.current_bytes += self.size(image)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.current_bytes -= self.size(evicted)
+
+    def clear(self):
+        with self.lock:
+            self._images.clear()
+            self.current_bytes = 0
@@ -0,0 +1,124 @@
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from profiler import PROFILER
+
+# Percentiles of bigger images are computed on a strided subsample of about this many pixels
+DEFAULT_MAX_SAMPLES = 1024 * 1024
+# Downsampled display levels kept across channel switches
+DEFAULT_PYRAMID_BYTES = 128 * 1024 ** 2
+
+ImageStats = namedtuple("ImageStats", ["vmin", "vmax", "mean", "std"])
+
+
+def contrast_range(image, low=10, high=90, max_samples=DEFAULT_MAX_SAMPLES):
+    # Both percentiles from a single partition of the finite values
+    data = image.ravel()
+    if data.size > max_samples:
+        data = data[::-(-data.size // max_samples)]
+    with PROFILER.span("percentile", data.nbytes):
+        # Boolean indexing already makes the copy np.percentile would otherwise make
+        data = data[np.isfinite(data)]
+        if data.size == 0:
+            return np.nan, np.nan
+        vmin, vmax = np.percentile(data, [low, high], overwrite_input=True)
+    return float(vmin), float(vmax)
+
+
+def image_stats(image, low=10, high=90, max_samples=DEFAULT_MAX_SAMPLES):
+    with PROFILER.span("image_stats", image.nbytes):
+        data = image.ravel()
+        finite = np.isfinite(data)
+        if not finite.all():
+            data = data[finite]
+        if data.size == 0:
+            return ImageStats(np.nan, np.nan, np.nan, np.nan)
+        vmin, vmax = contrast_range(data, low, high, max_samples)
+        return ImageStats(vmin, vmax, float(data.mean()), float(data.std()))
+
+
+class StatsCache:
+    # Display range and full image stats per channel, so redraws after "Add New Area"
+    # or "Drop" reuse them instead of going over the whole image again
+    def __init__(self, low=10, high=90, max_samples=DEFAULT_MAX_SAMPLES):
+        self.low = low
+        self.high = high
+        self.max_samples = max_samples
+        self._stats = {}
+
+    def get(self, key, image):
+        if key not in self._stats:
+            self._stats[key] = image_stats(image, self.low, self.high, self.max_samples)
+        return self._stats[key]
+
+    def clear(self):
+        self._stats.clear()
+
+
+def downsample(image):
+    # 2x2 block mean, an odd last row/column is dropped
+    h, w = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    blocks = image[:h, :w].reshape(h // 2, 2, w // 2, 2)
+    return blocks.mean(axis=(1, 3))
+
+
+class ImagePyramid:
+    # Downsampled copies of a channel for display, levels[i] is downsampled 2 ** (i + 1) times.
+    # The full resolution image is not kept here, the caller passes it back to level_for.
+    def __init__(self, image, min_size=256):
+        self.levels = []
+        with PROFILER.span("pyramid", image.nbytes):
+            level = image
+            while min(level.shape) // 2 >= min_size:
+                level = downsample(level)
+                self.levels.append(level)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def level_for(self, image, width_px, height_px):
+        # Coarsest level that still has at least one image pixel per screen pixel
+        for index, level in reversed(list(enumerate(self.levels, 1))):
+            if level.shape[1] >= width_px and level.shape[0] >= height_px:
+                return level, 2 ** index
+        return image, 1
+
+
+class PyramidCache:
+    # LRU by bytes like the channel cache, the pyramid of the shown channel is the last one used
+    def __init__(self, min_size=256, max_bytes=DEFAULT_PYRAMID_BYTES):
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._pyramids = OrderedDict()
+
+    def get(self, key, image):
+        if key in self._pyramids:
+            self._pyramids.move_to_end(key)
+            return self._pyramids[key]
+        pyramid = ImagePyramid(image, self.min_size)
+        self._pyramids[key] = pyramid
+        self.current_bytes += pyramid.nbytes
+        # The pyramid just built stays even past the budget
+        while self.current_bytes > self.max_bytes and len(self._pyramids) > 1:
+            _, evicted = self._pyramids.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+        return pyramid
+
+    def clear(self):
+        self._pyramids.clear()
+        self.current_bytes = 0
+
+
+def draw_tile_heatmap(ax, values, stride, cmap="viridis", alpha=0.5):
+    # One cell per tile on top of the image, in its full resolution pixel coordinates. The view
+    # limits are kept, the next ax.clear() removes it.
+    rows, cols = values.shape
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    heatmap = ax.imshow(values, cmap=cmap, alpha=alpha, interpolation="nearest", zorder=2,
+                        extent=(-0.5, cols * stride - 0.5, rows * stride - 0.5, -0.5))
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    return heatmap
@@ -0,0 +1,236 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from profiler import PROFILER
+
+# pyarrow is only needed for the Parquet and Feather formats
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_FORMATS = ["parquet", "feather", "excel"]
+EXTENSIONS = {"parquet": ".parquet", "feather": ".feather", "excel": ".xlsx"}
+# Tables written by apps without an export format dropdown
+DEFAULT_TABLE_FORMAT = "parquet" if pa is not None else "excel"
+
+
+def build_table(names, columns, class_label=None):
+    # One column per channel plus the class label, the arrays are handed to Arrow as they are
+    with PROFILER.span("build_table"):
+        arrays = [pa.array(np.asarray(column)) for column in columns]
+        fields = list(names)
+        if class_label is not None:
+            arrays.append(pa.repeat(str(class_label), len(columns[0]) if columns else 0))
+            fields.append("class")
+        return pa.table(arrays, names=fields)
+
+
+def write_parquet(file_path, names, columns, class_label=None):
+    pq.write_table(build_table(names, columns, class_label), file_path)
+
+
+def write_feather(file_path, names, columns, class_label=None):
+    feather.write_feather(build_table(names, columns, class_label), file_path)
+
+
+def write_excel(file_path, names, columns, class_label=None):
+    # Same layout as the original per-area Excel files, openpyxl writes it cell by cell
+    df = pd.DataFrame(dict(zip(names, columns)))
+    if class_label is not None:
+        df['class'] = class_label
+    df.to_excel(file_path)
+
+
+WRITERS = {"parquet": write_parquet, "feather": write_feather, "excel": write_excel}
+
+
+def write_columns(file_base, names, columns, export_format="parquet", class_label=None):
+    if export_format not in WRITERS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if export_format != "excel" and pa is None:
+        raise ImportError(f"pyarrow is required for the {export_format} export format")
+    file_path = f"{file_base}{EXTENSIONS[export_format]}"
+    with PROFILER.span(f"write_{export_format}", sum(np.asarray(column).nbytes for column in columns)):
+        WRITERS[export_format](file_path, names, columns, class_label)
+    return file_path
+
+
+def write_stack(file_path, names, areas):
+    # All channels of an area as one (C, H, W) array. The areas are copied straight into the
+    # memory-mapped .npy, so no stacked copy is built in RAM. Channel names go to a .txt next to it.
+    stack = None
+    try:
+        for i, area in enumerate(areas):
+            if stack is None:
+                stack = np.lib.format.open_memmap(file_path, mode="w+", dtype=area.dtype,
+                                                  shape=(len(names),) + area.shape)
+            with PROFILER.span("write_stack", area.nbytes):
+                stack[i] = area
+    except BaseException:
+        # Do not leave a half written stack behind (cancelled export, failed decode...)
+        if stack is not None:
+            del stack
+            os.remove(file_path)
+        raise
+    if stack is None:
+        raise ValueError("No channels to write")
+    stack.flush()
+    del stack
+    names_path = f"{file_path[:-len('.npy')]}_channels.txt"
+    with open(names_path, "w") as file:
+        for name in names:
+            file.write(f"{name}\n")
+    return file_path
+
+
+class TableWriter:
+    # Rows appended as they are computed, one column per key of the first row. Parquet and
+    # Feather are written batch by batch, Excel has no streaming writer and is written on close.
+    def __init__(self, file_base, export_format="parquet", batch_size=256):
+        if export_format not in WRITERS:
+            raise ValueError(f"Unknown export format: {export_format}")
+        if export_format != "excel" and pa is None:
+            raise ImportError(f"pyarrow is required for the {export_format} export format")
+        self.file_path = f"{file_base}{EXTENSIONS[export_format]}"
+        self.export_format = export_format
+        self.batch_size = batch_size
+        self.columns = None
+        self.rows = []
+        self.n_rows = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, row):
+        if self.columns is None:
+            self.columns = list(row)
+        self.rows.append(row)
+        self.n_rows += 1
+        if self.export_format != "excel" and len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows or self.export_format == "excel":
+            return
+        batch = pa.Table.from_pylist([{name: row.get(name) for name in self.columns} for row in self.rows],
+                                     schema=self._schema)
+        if self._writer is None:
+            self._schema = batch.schema
+            if self.export_format == "parquet":
+                self._writer = pq.ParquetWriter(self.file_path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.file_path, self._schema)
+        with PROFILER.span(f"write_{self.export_format}", batch.nbytes):
+            self._writer.write_table(batch)
+        self.rows = []
+
+    def close(self):
+        if self.export_format == "excel":
+            if self.rows:
+                with PROFILER.span("write_excel"):
+                    pd.DataFrame(self.rows, columns=self.columns).to_excel(self.file_path)
+        else:
+            self.flush()
+            if self._writer is not None:
+                self._writer.close()
+        return self.file_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+# Rows per Parquet row group / Feather record batch / Excel block of a streamed export
+STREAM_BLOCK_ROWS = 1 << 16
+
+
+class ExcelBlockWriter:
+    # openpyxl write-only workbook, rows go straight to the file instead of a cell tree in memory.
+    # Same layout as DataFrame.to_excel: a header row, then the row index and one cell per column.
+    def __init__(self, file_path, names, class_label=None):
+        import openpyxl
+        self.file_path = file_path
+        self.class_label = class_label
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append([None, *names] + (["class"] if class_label is not None else []))
+        self.n_rows = 0
+
+    def write_columns(self, columns):
+        extra = [self.class_label] if self.class_label is not None else []
+        for row in zip(*[column.tolist() for column in columns]):
+            self.sheet.append([self.n_rows, *row] + extra)
+            self.n_rows += 1
+
+    def close(self):
+        self.workbook.save(self.file_path)
+
+
+def stream_columns(file_base, channels, export_format="parquet", class_label=None, job=None,
+                   block_rows=STREAM_BLOCK_ROWS):
+    # write_columns for columns too large to hold together: `channels` yields (name, image) one
+    # at a time, each image is appended to a raw spill file next to the output and dropped, then
+    # the table is written in blocks of rows read back from it with plain reads (no mapping, so
+    # the spilled data does not stay resident). Peak memory is one channel plus one block,
+    # whatever the channel count.
+    if export_format not in WRITERS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    if export_format != "excel" and pa is None:
+        raise ImportError(f"pyarrow is required for the {export_format} export format")
+    file_path = f"{file_base}{EXTENSIONS[export_format]}"
+    spill_path = f"{file_base}.spill"
+    names = []
+    dtype = n_rows = writer = None
+    try:
+        with open(spill_path, "w+b") as spill:
+            for name, image in channels:
+                if dtype is None:
+                    dtype, n_rows = image.dtype, image.size
+                elif image.size != n_rows:
+                    raise ValueError(f"{name}: {image.size} values, the previous channels have {n_rows}")
+                with PROFILER.span("write_spill", image.nbytes):
+                    np.ascontiguousarray(image, dtype=dtype).tofile(spill)
+                names.append(name)
+            if dtype is None:
+                raise ValueError("No channels to write")
+
+            def read_block(i, offset):
+                spill.seek((i * n_rows + offset) * dtype.itemsize)
+                return np.fromfile(spill, dtype=dtype, count=min(block_rows, n_rows - offset))
+
+            with PROFILER.span(f"write_{export_format}", len(names) * n_rows * dtype.itemsize):
+                if export_format == "excel":
+                    writer = ExcelBlockWriter(file_path, names, class_label)
+                else:
+                    schema = build_table(names, [np.empty(0, dtype) for _ in names], class_label).schema
+                    if export_format == "parquet":
+                        writer = pq.ParquetWriter(file_path, schema)
+                    else:
+                        writer = pa.ipc.new_file(file_path, schema)
+                for offset in range(0, n_rows, block_rows):
+                    if job is not None:
+                        job.check_cancelled()
+                    columns = [read_block(i, offset) for i in range(len(names))]
+                    if export_format == "excel":
+                        writer.write_columns(columns)
+                    else:
+                        writer.write_table(build_table(names, columns, class_label))
+                writer.close()
+    except BaseException:
+        # Do not leave a partial table behind (cancelled export, failed decode...)
+        if writer is not None and export_format != "excel":
+            writer.close()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    finally:
+        if os.path.exists(spill_path):
+            os.remove(spill_path)
+    return file_path
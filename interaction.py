@@ -0,0 +1,145 @@
+import time
+
+# Motion events are coalesced to this rate while dragging
+DEFAULT_REFRESH_RATE = 60
+
+
+class BlitManager:
+    # Keeps a copy of the static figure and redraws only the animated artists on top of it,
+    # so dragging a rectangle does not re-render the full image and the subplot on every motion.
+    def __init__(self, canvas, refresh_rate=DEFAULT_REFRESH_RATE):
+        self.canvas = canvas
+        self.min_interval = 1.0 / refresh_rate
+        self.background = None
+        self.artists = []
+        self.last_update = 0.0
+        self.timer = None
+        # The background is re-captured after every full draw (new image, resize, release...)
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for artist in self.artists:
+            if artist.axes is not None:
+                artist.axes.draw_artist(artist)
+
+    def start(self, artist):
+        # Full draw once without the artist, then only blit it until stop()
+        artist.set_animated(True)
+        self.artists.append(artist)
+        self.canvas.draw()
+
+    def stop(self):
+        for artist in self.artists:
+            artist.set_animated(False)
+        self.artists = []
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        # One full redraw with the artists back in the static scene
+        self.canvas.draw_idle()
+
+    def request_update(self):
+        if self.timer is not None:
+            # An update is already scheduled, it will pick up the latest artist position
+            return
+        wait = self.min_interval - (time.perf_counter() - self.last_update)
+        if wait <= 0:
+            self.update()
+        else:
+            self.timer = self.canvas.new_timer(interval=int(wait * 1000) + 1)
+            self.timer.single_shot = True
+            self.timer.add_callback(self.on_timer)
+            self.timer.start()
+
+    def on_timer(self):
+        self.timer = None
+        if self.artists:
+            self.update()
+
+    def update(self):
+        self.last_update = time.perf_counter()
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+
+
+class InteractionDispatcher:
+    # Connected to the canvas once for the lifetime of the app and routes the mouse events
+    # to the current tool, so re-drawing the image never stacks extra handlers.
+    HANDLERS = {
+        "button_press_event": "on_press",
+        "motion_notify_event": "on_drag",
+        "button_release_event": "on_release",
+    }
+
+    def __init__(self, canvas, tool=None, refresh_rate=DEFAULT_REFRESH_RATE):
+        self.canvas = canvas
+        self.tool = tool
+        self.min_interval = 1.0 / refresh_rate
+        self.event_counts = dict.fromkeys(self.HANDLERS, 0)
+        self.handler_calls = dict.fromkeys(self.HANDLERS, 0)
+        self.pending_motion = None
+        self.last_motion = 0.0
+        self.timer = None
+        self.cids = [self.canvas.mpl_connect(name, self.dispatch) for name in self.HANDLERS]
+
+    def set_tool(self, tool):
+        self.flush_motion()
+        self.tool = tool
+
+    def dispatch(self, event):
+        self.event_counts[event.name] += 1
+        if event.name == "motion_notify_event":
+            self.throttle_motion(event)
+        else:
+            # The tool has to see the last position before the press/release
+            self.flush_motion()
+            self.call(event)
+
+    def throttle_motion(self, event):
+        self.pending_motion = event
+        if self.timer is not None:
+            return
+        wait = self.min_interval - (time.perf_counter() - self.last_motion)
+        if wait <= 0:
+            self.flush_motion()
+        else:
+            self.timer = self.canvas.new_timer(interval=int(wait * 1000) + 1)
+            self.timer.single_shot = True
+            self.timer.add_callback(self.flush_motion)
+            self.timer.start()
+
+    def flush_motion(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        if self.pending_motion is not None:
+            event, self.pending_motion = self.pending_motion, None
+            self.last_motion = time.perf_counter()
+            self.call(event)
+
+    def call(self, event):
+        handler = getattr(self.tool, self.HANDLERS[event.name], None)
+        if handler is not None:
+            self.handler_calls[event.name] += 1
+            handler(event)
+
+    def calls_per_event(self):
+        # Should never exceed 1, motion events that were coalesced bring it below
+        return {
+            name: self.handler_calls[name] / count if count else 0.0
+            for name, count in self.event_counts.items()
+        }
+
+    def disconnect(self):
+        for cid in self.cids:
+            self.canvas.mpl_disconnect(cid)
+        self.cids = []
@@ -5,6 +5,14 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from nptdms import TdmsFile
 import os
+from readers import open_scan
+from channel_cache import ChannelCache, DEFAULT_CACHE_BYTES
+from interaction import BlitManager, InteractionDispatcher
+from display import StatsCache, PyramidCache, contrast_range, draw_tile_heatmap
+from exporters import DEFAULT_TABLE_FORMAT, write_columns, write_stack
+from background import JobPanel
+from tiling import tile_origins, tile_stats, tile_stats_columns
+from profiler import PROFILER, profiled
 
 class ImageSelectorApp:
     def __init__(self, root):
@@ -25,6 +33,9 @@ class ImageSelectorApp:
         self.stats_button = tk.Button(button_frame, text="Compute Stats", command=self.compute_stats)
         self.stats_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.tile_stats_button = tk.Button(button_frame, text="Tile Stats", command=self.compute_tile_stats)
+        self.tile_stats_button.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.add_area_button = tk.Button(button_frame, text="Add New Area", command=self.enable_add_area)
         self.add_area_button.pack(side=tk.LEFT, padx=5, pady=5)
 
@@ -61,6 +72,11 @@ class ImageSelectorApp:
         self.size_entry = tk.Entry(size_frame, width=5)
         self.size_entry.pack(side=tk.LEFT, padx=5)
         self.size_entry.insert(0, "256")
+        tk.Label(size_frame, text="Export mode:").pack(side=tk.LEFT, padx=5)
+        self.export_mode_var = tk.StringVar(value="channels")  # "stack" writes one (C, H, W) .npy per area
+        self.export_mode_dropdown = ttk.Combobox(size_frame, textvariable=self.export_mode_var, state="readonly", width=8)
+        self.export_mode_dropdown['values'] = ['channels', 'stack']
+        self.export_mode_dropdown.pack(side=tk.LEFT, padx=5)
 
         self.info_label = tk.Label(root, text="Load an image file to start.")
         self.info_label.pack()
@@ -68,10 +84,16 @@ class ImageSelectorApp:
         self.stats_label = tk.Label(root, text="")
         self.stats_label.pack()
 
+        # Exports run on a worker thread, the progress is polled from the Tk loop
+        self.jobs = JobPanel(root, self.info_label)
+
         self.figure, (self.ax, self.ax_sub) = plt.subplots(1, 2, figsize=(10, 5))
         self.canvas = FigureCanvasTkAgg(self.figure, master=root)
         self.canvas_widget = self.canvas.get_tk_widget()
         self.canvas_widget.pack()
+        self.blit_manager = BlitManager(self.canvas)
+        # Mouse handlers are connected once here, show_image only redraws
+        self.dispatcher = InteractionDispatcher(self.canvas, tool=self)
 
         self.image_data = None
         self.rect = None
@@ -80,7 +102,14 @@ class ImageSelectorApp:
         self.rect_size = 20  # Fixed size of the rectangle
         self.is_dragging = False
         self.extracted_area = None
-        self.tdms_blend = None  # Store the TDMS file object
+        self.tdms_blend = None  # Reader of the loaded scan (readers.py)
+        self.file_path = None
+        self.load_job = None  # Background load in progress
+        self.channel_cache = ChannelCache(max_bytes=DEFAULT_CACHE_BYTES)  # Decoded channels shared by display and export
+        self.stats_cache = StatsCache()  # Display range and stats of every shown channel
+        self.pyramid_cache = PyramidCache()  # Downsampled levels used to draw large scans
+        self.image_key = None
+        self.lazy_loading = True  # Only read the TDMS metadata on load, channels are decoded on demand
         self.sh = None
         self.add_area_mode = False
         self.directory = None
@@ -92,69 +121,147 @@ class ImageSelectorApp:
         self.colors = ['red', 'blue', 'green', 'purple', 'black']
 
 
+    @profiled
     def load_data(self):
-        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("All files", "*.*")])
-        ### Reinitialize the rectangles data if a new image is loaded
-        self.reset_area_cash()
-        self.directory, self.file_name = os.path.split(file_path)
+        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("NumPy arrays", "*.npy *.npz"), ("All files", "*.*")])
         if file_path:
-            try:
-                self.tdms_blend = TdmsFile.read(file_path)
-                scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
+            # The file is parsed on the loader thread, the channel dropdown is filled as soon as
+            # the channel names are known and the image is shown once its data is decoded
+            self.channel_dropdown.config(state="disabled")
+            self.channel_cache.clear()
+            self.stats_cache.clear()
+            self.pyramid_cache.clear()
+            lazy = self.lazy_loading
+            scan_dir = self.scan_dir_var.get()
+            selected = self.channel_var.get()
+
+            def load(job):
+                scan = open_scan(file_path, lazy=lazy)
+                job.source = (file_path, scan)
+                channels = scan.channels(scan_dir)
+                if not channels:
+                    raise ValueError("no channels found")
+                job.post(self.on_file_opened, job, channels)
+                channel = selected if selected in channels else channels[0]
+                self.channel_cache.get(
+                    (file_path, scan_dir, channel),
+                    lambda: scan.read(channel, scan_dir, job),
+                )
 
-                # Populate channel dropdown
-                self.channel_dropdown['values'] = channels
-                if not self.channel_var.get():
-                    self.channel_var.set(channels[0])
+            self.load_job = self.jobs.load(f"Loading {os.path.basename(file_path)}", load, on_done=self.on_file_loaded)
 
-                self.update_image()
-            except Exception as e:
-                self.info_label.config(text=f"Error loading file: {e}")
+    def on_file_opened(self, job, channels):
+        if job is not self.load_job or job.cancelled:
+            return
+        job.installed = True
+        self.close_file()
+        self.file_path, self.tdms_blend = job.source
+        ### Reinitialize the rectangles data if a new image is loaded
+        self.reset_area_cash()
+        self.directory, self.file_name = os.path.split(self.file_path)
+
+        # Populate channel dropdown
+        self.channel_dropdown['values'] = channels
+        self.channel_dropdown.config(state="readonly")
+        if self.channel_var.get() not in channels:
+            self.channel_var.set(channels[0])
+        self.info_label.config(text=f"{len(channels)} channels found, decoding the image...")
+
+    def on_file_loaded(self, job):
+        if job is not self.load_job:
+            # Replaced by a newer load, its file was never shown
+            if job.source is not None and not job.installed:
+                self.discard_source(job.source)
+            return
+        self.load_job = None
+        if job.cancelled or job.error is not None:
+            if job.installed:
+                self.close_file()
+                self.image_data = None
+                self.channel_dropdown['values'] = []
+            elif job.source is not None:
+                self.discard_source(job.source)
+            self.channel_dropdown.config(state="readonly")
+            if job.cancelled:
+                self.info_label.config(text="File loading cancelled.")
+            else:
+                self.info_label.config(text=f"Error loading file: {job.error}")
+        else:
+            self.update_image()
+
+    def discard_source(self, source):
+        source[1].close()
 
+    def close_file(self):
+        if self.tdms_blend is not None:
+            # Queued exports may still read the previous file, close it after them
+            previous_file = self.tdms_blend
+            self.jobs.worker.after_queued(previous_file.close)
+        self.tdms_blend = None
+
+    def get_channel_image(self, channel, scan_dir=None, source=None):
+        # Background jobs pass the (file_path, scan) they were queued with
+        file_path, scan = source or (self.file_path, self.tdms_blend)
+        scan_dir = scan_dir or self.scan_dir_var.get()
+        return self.channel_cache.get(
+            (file_path, scan_dir, channel),
+            lambda: scan.read(channel, scan_dir),
+        )
+
+    def get_image_stats(self):
+        return self.stats_cache.get(self.image_key, self.image_data)
+
+    def get_display_image(self):
+        # Level matching the size of the axes on screen, full resolution is kept for the
+        # selected area and the exports
+        bbox = self.ax.get_window_extent()
+        pyramid = self.pyramid_cache.get(self.image_key, self.image_data)
+        level, _ = pyramid.level_for(self.image_data, bbox.width, bbox.height)
+        return level
+
+    @profiled
     def update_image(self, event=None):
         if self.tdms_blend is not None:
             try:
                 scan_dir = self.scan_dir_var.get()
                 channel = self.channel_var.get()
                 if scan_dir and channel:
-                    tmp = self.tdms_blend[scan_dir][channel].data
-                    self.sh = int(np.sqrt(tmp.shape[0]))
-                    self.image_data = tmp.reshape(self.sh, self.sh)
+                    self.image_data = self.get_channel_image(channel, scan_dir)
+                    self.image_key = (self.file_path, scan_dir, channel)
+                    self.sh = self.image_data.shape[0]
 
                     self.show_image()
 
                     # Compute and display stats for the entire image
-                    mean_value = np.mean(self.image_data)
-                    std_dev = np.std(self.image_data)
-                    self.stats_label.config(text=f"Full Image Stats - Mean: {mean_value:.2f}, Std Dev: {std_dev:.2f}")
+                    stats = self.get_image_stats()
+                    self.stats_label.config(text=f"Full Image Stats - Mean: {stats.mean:.2f}, Std Dev: {stats.std:.2f}")
             except Exception as e:
                 self.info_label.config(text=f"Error updating image: {e}")
 
 
+    @profiled
     def show_image(self):
         if self.image_data is not None:
             #print(np.amin(self.image_data),np.amax(self.image_data))
             #print(np.percentile(self.image_data, 10),np.percentile(self.image_data, 90))
-            vmin = np.percentile(np.nan_to_num(self.image_data,0), 10)
-            vmax = np.percentile(np.nan_to_num(self.image_data,0), 90)
+            stats = self.get_image_stats()
             self.ax.clear()
-            self.ax.imshow(self.image_data, vmin=vmin, vmax=vmax, cmap='YlOrBr_r')
+            h, w = self.image_data.shape
+            # The extent keeps the axes in full resolution pixels whatever level is drawn
+            self.ax.imshow(self.get_display_image(), vmin=stats.vmin, vmax=stats.vmax, cmap='YlOrBr_r',
+                           extent=(-0.5, w - 0.5, h - 0.5, -0.5))
             #self.ax.set_title("Drag to select an area")
             self.ax.set_title(self.file_name)
             self.ax_sub.clear()
             self.ax_sub.set_title("Selected Area")
-            self.canvas.draw()
+            with PROFILER.span("draw"):
+                self.canvas.draw()
 
             ## Draws the previously saved areas if we change channel
             if self.rectangles:
                 for rect in self.rectangles:
                     self.ax.add_patch(rect)
 
-            self.canvas.mpl_connect("button_press_event", self.on_press)
-            self.canvas.mpl_connect("motion_notify_event", self.on_drag)
-            self.canvas.mpl_connect("button_release_event", self.on_release)
-
     def enable_add_area(self):
         self.add_area_mode = True
         if self.last_rectangle:
@@ -202,7 +309,7 @@ class ImageSelectorApp:
                     facecolor="none",
                 )
             )
-            self.canvas.draw()
+            self.blit_manager.start(self.rect)
 
     def on_drag(self, event):
         if self.add_area_mode and self.is_dragging and event.inaxes == self.ax:
@@ -221,11 +328,12 @@ class ImageSelectorApp:
 
             if self.rect:
                 self.rect.set_xy((self.start_x - self.rect_size // 2, self.start_y - self.rect_size // 2))
-            self.canvas.draw()
+            self.blit_manager.request_update()
 
     def on_release(self, event):
         if self.add_area_mode and self.is_dragging:
             self.is_dragging = False
+            self.blit_manager.stop()
 
             # Finalize the rectangle
             self.last_rectangle = self.rect  # Keep track of the last selected rectangle
@@ -233,6 +341,7 @@ class ImageSelectorApp:
 
             self.extract_area()
 
+    @profiled
     def extract_area(self):
         if self.image_data is not None:
             x_start = max(self.start_x - self.rect_size // 2, 0)
@@ -249,52 +358,113 @@ class ImageSelectorApp:
 
                 # Plot selected area in the subplot
                 self.ax_sub.clear()
-                vmin = np.percentile(np.nan_to_num(self.extracted_area,0), 10)
-                vmax = np.percentile(np.nan_to_num(self.extracted_area,0), 90)
+                vmin, vmax = contrast_range(self.extracted_area)
                 self.ax_sub.imshow(self.extracted_area, vmin=vmin, vmax=vmax, cmap='YlOrBr_r')
                 self.ax_sub.set_title("Selected Area")
-                self.canvas.draw()
+                self.canvas.draw_idle()
             else:
                 self.info_label.config(text="Selected area is out of bounds!")
 
+    @profiled
     def save_area(self):
         if self.image_data is not None and self.tdms_blend is not None:
             directory_path = filedialog.askdirectory(initialdir=self.directory,title="Select Directory to Save Areas")
             if directory_path:
                 scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
-
-                for channel in channels:
-                    try:
-                        # Extract data for the channel
-                        channel_data = self.tdms_blend[scan_dir][channel].data
-                        sh = int(np.sqrt(channel_data.shape[0]))
-                        channel_image = channel_data.reshape(sh, sh)
-
-                        # Extract selected area for the channel
-                        x_start = max(self.start_x - self.rect_size // 2, 0)
-                        y_start = max(self.start_y - self.rect_size // 2, 0)
-                        x_end = min(x_start + self.rect_size, channel_image.shape[1])
-                        y_end = min(y_start + self.rect_size, channel_image.shape[0])
-
-                        extracted_area = channel_image[y_start:y_end, x_start:x_end]
-
-                        if extracted_area.shape == (self.rect_size, self.rect_size):
-                            # Save the extracted area to a file
-                            file_name = f"{self.file_name}_AREA{self.area_counter}_{channel}_selected_area.npy"
-                            file_path = f"{directory_path}/{file_name}"
-                            np.save(file_path, extracted_area)
-                        else:
-                            self.info_label.config(text=f"Selected area out of bounds for channel: {channel}")
-                    except Exception as e:
-                        self.info_label.config(text=f"Error processing channel {channel}: {e}")
-
-                self.info_label.config(text="Selected areas saved for all channels!")
+                channels = self.tdms_blend.channels(scan_dir)
+
+                # Everything the export needs is captured now, the job itself runs on the worker thread
+                source = (self.file_path, self.tdms_blend)
+                x_start = max(self.start_x - self.rect_size // 2, 0)
+                y_start = max(self.start_y - self.rect_size // 2, 0)
+                rect_size = self.rect_size
+                file_base = f"{directory_path}/{self.file_name}_AREA{self.area_counter}"
+                stack_mode = self.export_mode_var.get() == "stack"
+                img_height, img_width = self.image_data.shape
+                if stack_mode and (x_start + rect_size > img_width or y_start + rect_size > img_height):
+                    self.info_label.config(text="Selected area is out of bounds!")
+                    return
+
+                def extract_areas(job):
+                    for i, channel in enumerate(channels):
+                        job.check_cancelled()
+                        channel_image = self.get_channel_image(channel, scan_dir, source)
+                        # A view of the cached channel, write_stack copies it into the file
+                        yield channel_image[y_start:y_start + rect_size, x_start:x_start + rect_size]
+                        job.report(i + 1, len(channels))
+
+                def export(job):
+                    if stack_mode:
+                        file_path = write_stack(f"{file_base}_selected_area_stack.npy", channels, extract_areas(job))
+                        return f"Selected area saved as a channel stack: {file_path}"
+                    for i, channel in enumerate(channels):
+                        job.check_cancelled()
+                        try:
+                            # Extract data for the channel
+                            channel_image = self.get_channel_image(channel, scan_dir, source)
+
+                            # Extract selected area for the channel
+                            extracted_area = channel_image[y_start:y_start + rect_size, x_start:x_start + rect_size]
+
+                            if extracted_area.shape == (rect_size, rect_size):
+                                # Save the extracted area to a file
+                                np.save(f"{file_base}_{channel}_selected_area.npy", extracted_area)
+                            else:
+                                job.warn(f"Selected area out of bounds for channel: {channel}")
+                        except Exception as e:
+                            job.warn(f"Error processing channel {channel}: {e}")
+                        job.report(i + 1, len(channels))
+                    return "Selected areas saved for all channels!"
+
+                self.jobs.submit(f"Saving area {self.area_counter}", export)
             else:
                 self.info_label.config(text="Save operation canceled.")
         else:
             self.info_label.config(text="No area selected or no data loaded to save.")
 
+    @profiled
+    def compute_tile_stats(self):
+        if self.image_data is not None and self.tdms_blend is not None:
+            try:
+                tile_size = int(self.size_entry.get())
+            except ValueError:
+                self.info_label.config(text="Invalid tile size.")
+                return
+            # Heatmap of the tile means of the shown channel, the next redraw removes it
+            stats = tile_stats(self.image_data, tile_size)
+            if stats["mean"].size == 0:
+                self.info_label.config(text="The image is smaller than one tile.")
+                return
+            draw_tile_heatmap(self.ax, stats["mean"], tile_size)
+            self.canvas.draw_idle()
+
+            # Stats of every tile of every channel, computed and saved on the worker thread
+            scan_dir = self.scan_dir_var.get()
+            channels = self.tdms_blend.channels(scan_dir)
+            source = (self.file_path, self.tdms_blend)
+            export_format = DEFAULT_TABLE_FORMAT
+            file_base = f"{self.directory}/{self.file_name}_TILESTATS{tile_size}"
+
+            def export(job):
+                channel_stats = {}
+                for i, channel in enumerate(channels):
+                    job.check_cancelled()
+                    try:
+                        channel_image = self.get_channel_image(channel, scan_dir, source)
+                        channel_stats[channel] = (tile_origins(channel_image.shape, tile_size),
+                                                  tile_stats(channel_image, tile_size))
+                    except Exception as e:
+                        job.warn(f"Error processing channel {channel}: {e}")
+                    job.report(i + 1, len(channels))
+                names, columns = tile_stats_columns(channel_stats)
+                file_path = write_columns(file_base, names, columns, export_format)
+                print(f"Saved {file_path}")
+                return f"Tile stats saved for all channels: {os.path.basename(file_path)}"
+
+            self.jobs.submit(f"Computing {tile_size} px tile stats", export)
+        else:
+            self.info_label.config(text="No data loaded to compute tile stats.")
+
     def compute_stats(self):
         if self.extracted_area is not None:
             mean_value = np.mean(self.extracted_area)
@@ -10,6 +10,14 @@ import pySPM
 import contextlib
 import re
 import pandas as pd
+from readers import open_scan
+from channel_cache import ChannelCache, DEFAULT_CACHE_BYTES
+from interaction import BlitManager, InteractionDispatcher
+from display import StatsCache, PyramidCache, contrast_range, draw_tile_heatmap
+from exporters import EXPORT_FORMATS, stream_columns, write_columns
+from background import JobPanel
+from tiling import tile_origins, tile_stats, tile_stats_columns
+from profiler import PROFILER, profiled
 
 class ImageSelectorApp:
     def __init__(self, root):
@@ -30,6 +38,9 @@ class ImageSelectorApp:
         self.stats_button = tk.Button(button_frame, text="Compute Stats", command=self.compute_stats)
         self.stats_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.tile_stats_button = tk.Button(button_frame, text="Tile Stats", command=self.compute_tile_stats)
+        self.tile_stats_button.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.add_area_button = tk.Button(button_frame, text="Add New Area", command=self.enable_add_area)
         self.add_area_button.pack(side=tk.LEFT, padx=5, pady=5)
 
@@ -78,16 +89,30 @@ class ImageSelectorApp:
         self.class_entry.pack(side=tk.LEFT, padx=5)
         self.class_entry.insert(0, "0")
 
+        format_frame = tk.Frame(root)
+        format_frame.pack()
+        tk.Label(format_frame, text="Export format:").pack(side=tk.LEFT, padx=5)
+        self.export_format_var = tk.StringVar(value="parquet")
+        self.export_format_dropdown = ttk.Combobox(format_frame, textvariable=self.export_format_var, state="readonly", width=8)
+        self.export_format_dropdown['values'] = EXPORT_FORMATS
+        self.export_format_dropdown.pack(side=tk.LEFT, padx=5)
+
         self.info_label = tk.Label(root, text="Load an image file to start.")
         self.info_label.pack()
 
         self.stats_label = tk.Label(root, text="")
         self.stats_label.pack()
 
+        # Exports run on a worker thread, the progress is polled from the Tk loop
+        self.jobs = JobPanel(root, self.info_label)
+
         self.figure, (self.ax, self.ax_sub) = plt.subplots(1, 2, figsize=(10, 5))
         self.canvas = FigureCanvasTkAgg(self.figure, master=root)
         self.canvas_widget = self.canvas.get_tk_widget()
         self.canvas_widget.pack()
+        self.blit_manager = BlitManager(self.canvas)
+        # Mouse handlers are connected once here, show_image only redraws
+        self.dispatcher = InteractionDispatcher(self.canvas, tool=self)
 
         self.image_data = None
         self.rect = None
@@ -96,7 +121,14 @@ class ImageSelectorApp:
         self.rect_size = 20  # Fixed size of the rectangle
         self.is_dragging = False
         self.extracted_area = None
-        self.tdms_blend = None  # Store the TDMS file object
+        self.tdms_blend = None  # Reader of the loaded scan (readers.py)
+        self.file_path = None
+        self.load_job = None  # Background load in progress
+        self.channel_cache = ChannelCache(max_bytes=DEFAULT_CACHE_BYTES)  # Decoded channels shared by display and export
+        self.stats_cache = StatsCache()  # Display range and stats of every shown channel
+        self.pyramid_cache = PyramidCache()  # Downsampled levels used to draw large scans
+        self.image_key = None
+        self.lazy_loading = True  # Only read the TDMS metadata on load, channels are decoded on demand
         self.sh = None
         self.add_area_mode = False
         self.directory = None
@@ -107,83 +139,149 @@ class ImageSelectorApp:
         self.area_counter = 0
         self.colors = ['red', 'blue', 'green', 'purple', 'black']
 
-    def extract_channel_names_bruker(self, Scan):
-        chans = []
-        for layer in Scan.layers:
-            with contextlib.suppress(KeyError):
-                temp = layer[b"@2:Image Data"][0].decode("latin1")
-                pattern = r'"(.*?)"'
-                match = re.search(pattern, temp)
-                extracted_channel_name = match.group(1)
-                chans.append(extracted_channel_name)
-        return chans
+    @profiled
+    def load_data(self):
+        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("NumPy arrays", "*.npy *.npz"), ("All files", "*.*")])
+        if file_path:
+            # The file is parsed on the loader thread, the channel dropdown is filled as soon as
+            # the channel names are known and the image is shown once its data is decoded
+            self.channel_dropdown.config(state="disabled")
+            self.channel_cache.clear()
+            self.stats_cache.clear()
+            self.pyramid_cache.clear()
+            lazy = self.lazy_loading
+            scan_dir = self.scan_dir_var.get()
+            selected = self.channel_var.get()
+
+            def load(job):
+                scan = open_scan(file_path, lazy=lazy)
+                job.source = (file_path, scan)
+                channels = scan.channels(scan_dir)
+                if not channels:
+                    raise ValueError("no channels found")
+                job.post(self.on_file_opened, job, channels)
+                channel = selected if selected in channels else channels[0]
+                self.channel_cache.get(
+                    (file_path, scan_dir, channel),
+                    lambda: scan.read(channel, scan_dir, job),
+                )
 
+            self.load_job = self.jobs.load(f"Loading {os.path.basename(file_path)}", load, on_done=self.on_file_loaded)
 
-    def load_data(self):
-        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("All files", "*.*")])
+    def on_file_opened(self, job, channels):
+        if job is not self.load_job or job.cancelled:
+            return
+        job.installed = True
+        self.close_file()
+        self.file_path, self.tdms_blend = job.source
         ### Reinitialize the rectangles data if a new image is loaded
         self.reset_area_cash()
-        self.directory, self.file_name = os.path.split(file_path)
+        self.directory, self.file_name = os.path.split(self.file_path)
         save_dir = f"{self.directory}/quadrants"
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
-        if file_path:
-            try:
-                self.tdms_blend = TdmsFile.read(file_path)
-                scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
 
-                # Populate channel dropdown
-                self.channel_dropdown['values'] = channels
-                if not self.channel_var.get():
-                    self.channel_var.set(channels[0])
+        # Populate channel dropdown
+        self.channel_dropdown['values'] = channels
+        self.channel_dropdown.config(state="readonly")
+        if self.channel_var.get() not in channels:
+            self.channel_var.set(channels[0])
+        self.info_label.config(text=f"{len(channels)} channels found, decoding the image...")
+
+    def on_file_loaded(self, job):
+        if job is not self.load_job:
+            # Replaced by a newer load, its file was never shown
+            if job.source is not None and not job.installed:
+                self.discard_source(job.source)
+            return
+        self.load_job = None
+        if job.cancelled or job.error is not None:
+            if job.installed:
+                self.close_file()
+                self.image_data = None
+                self.channel_dropdown['values'] = []
+            elif job.source is not None:
+                self.discard_source(job.source)
+            self.channel_dropdown.config(state="readonly")
+            if job.cancelled:
+                self.info_label.config(text="File loading cancelled.")
+            else:
+                self.info_label.config(text=f"Error loading file: {job.error}")
+        else:
+            self.update_image()
 
-                self.update_image()
-            except Exception as e:
-                self.info_label.config(text=f"Error loading file: {e}")
+    def discard_source(self, source):
+        source[1].close()
 
+    def close_file(self):
+        if self.tdms_blend is not None:
+            # Queued exports may still read the previous file, close it after them
+            previous_file = self.tdms_blend
+            self.jobs.worker.after_queued(previous_file.close)
+        self.tdms_blend = None
+
+    def get_channel_image(self, channel, scan_dir=None, source=None):
+        # Background jobs pass the (file_path, scan) they were queued with
+        file_path, scan = source or (self.file_path, self.tdms_blend)
+        scan_dir = scan_dir or self.scan_dir_var.get()
+        return self.channel_cache.get(
+            (file_path, scan_dir, channel),
+            lambda: scan.read(channel, scan_dir),
+        )
+
+    def get_image_stats(self):
+        return self.stats_cache.get(self.image_key, self.image_data)
+
+    def get_display_image(self):
+        # Level matching the size of the axes on screen, full resolution is kept for the
+        # selected area and the exports
+        bbox = self.ax.get_window_extent()
+        pyramid = self.pyramid_cache.get(self.image_key, self.image_data)
+        level, _ = pyramid.level_for(self.image_data, bbox.width, bbox.height)
+        return level
+
+    @profiled
     def update_image(self, event=None):
         if self.tdms_blend is not None:
             try:
                 scan_dir = self.scan_dir_var.get()
                 channel = self.channel_var.get()
                 if channel:
-                    tmp = self.tdms_blend[scan_dir][channel].data
-                    self.sh = int(np.sqrt(tmp.shape[0]))
-                    self.image_data = tmp.reshape(self.sh, self.sh)
+                    self.image_data = self.get_channel_image(channel, scan_dir)
+                    self.image_key = (self.file_path, scan_dir, channel)
+                    self.sh = self.image_data.shape[0]
                     self.show_image()
 
                     # Compute and display stats for the entire image
-                    mean_value = np.mean(self.image_data)
-                    std_dev = np.std(self.image_data)
-                    self.stats_label.config(text=f"Full Image Stats - Mean: {mean_value:.2f}, Std Dev: {std_dev:.2f}")
+                    stats = self.get_image_stats()
+                    self.stats_label.config(text=f"Full Image Stats - Mean: {stats.mean:.2f}, Std Dev: {stats.std:.2f}")
             except Exception as e:
                 self.info_label.config(text=f"Error updating image: {e}")
 
 
+    @profiled
     def show_image(self):
         if self.image_data is not None:
             #print(np.amin(self.image_data),np.amax(self.image_data))
             #print(np.percentile(self.image_data, 10),np.percentile(self.image_data, 90))
-            vmin = np.percentile(np.nan_to_num(self.image_data,0), 10)
-            vmax = np.percentile(np.nan_to_num(self.image_data,0), 90)
+            stats = self.get_image_stats()
             self.ax.clear()
-            self.ax.imshow(self.image_data, vmin=vmin, vmax=vmax, cmap='YlOrBr_r')
+            h, w = self.image_data.shape
+            # The extent keeps the axes in full resolution pixels whatever level is drawn
+            self.ax.imshow(self.get_display_image(), vmin=stats.vmin, vmax=stats.vmax, cmap='YlOrBr_r',
+                           extent=(-0.5, w - 0.5, h - 0.5, -0.5))
             #self.ax.set_title("Drag to select an area")
-            self.ax.set_title(f"{self.file_name}. Mean: {np.mean(self.image_data): .2f}")
+            self.ax.set_title(f"{self.file_name}. Mean: {stats.mean: .2f}")
             self.ax_sub.clear()
             self.ax_sub.set_title("Selected Area")
-            self.canvas.draw()
+            with PROFILER.span("draw"):
+                self.canvas.draw()
 
             ## Draws the previously saved areas if we change channel
             if self.rectangles:
                 for rect in self.rectangles:
                     self.ax.add_patch(rect)
 
-            self.canvas.mpl_connect("button_press_event", self.on_press)
-            self.canvas.mpl_connect("motion_notify_event", self.on_drag)
-            self.canvas.mpl_connect("button_release_event", self.on_release)
-
     def enable_add_area(self):
         self.add_area_mode = True
         if self.last_rectangle:
@@ -231,7 +329,7 @@ class ImageSelectorApp:
                     facecolor="none",
                 )
             )
-            self.canvas.draw()
+            self.blit_manager.start(self.rect)
 
     def on_drag(self, event):
         if self.add_area_mode and self.is_dragging and event.inaxes == self.ax:
@@ -250,11 +348,12 @@ class ImageSelectorApp:
 
             if self.rect:
                 self.rect.set_xy((self.start_x - self.rect_size // 2, self.start_y - self.rect_size // 2))
-            self.canvas.draw()
+            self.blit_manager.request_update()
 
     def on_release(self, event):
         if self.add_area_mode and self.is_dragging:
             self.is_dragging = False
+            self.blit_manager.stop()
 
             # Finalize the rectangle
             self.last_rectangle = self.rect  # Keep track of the last selected rectangle
@@ -262,6 +361,7 @@ class ImageSelectorApp:
 
             self.extract_area()
 
+    @profiled
     def extract_area(self):
         if self.image_data is not None:
             x_start = max(self.start_x - self.rect_size // 2, 0)
@@ -278,87 +378,146 @@ class ImageSelectorApp:
 
                 # Plot selected area in the subplot
                 self.ax_sub.clear()
-                vmin = np.percentile(np.nan_to_num(self.extracted_area,0), 10)
-                vmax = np.percentile(np.nan_to_num(self.extracted_area,0), 90)
+                vmin, vmax = contrast_range(self.extracted_area)
                 self.ax_sub.imshow(self.extracted_area, vmin=vmin, vmax=vmax, cmap='YlOrBr_r')
                 self.ax_sub.set_title("Selected Area")
-                self.canvas.draw()
+                self.canvas.draw_idle()
             else:
                 self.info_label.config(text="Selected area is out of bounds!")
 
+    @profiled
     def save_area(self):
         if self.image_data is not None and self.tdms_blend is not None:
             directory_path = self.directory#filedialog.askdirectory(initialdir=self.directory,title="Select Directory to Save Areas")
             if directory_path:
                 scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
-                data_list = []
-                for channel in channels:
-                    try:
-                        # Extract data for the channel
-                        channel_data = self.tdms_blend[scan_dir][channel].data
-                        sh = int(np.sqrt(channel_data.shape[0]))
-                        channel_image = channel_data.reshape(sh, sh)
-
-                        # Extract selected area for the channel
-                        x_start = max(self.start_x - self.rect_size // 2, 0)
-                        y_start = max(self.start_y - self.rect_size // 2, 0)
-                        x_end = min(x_start + self.rect_size, channel_image.shape[1])
-                        y_end = min(y_start + self.rect_size, channel_image.shape[0])
-
-                        extracted_area = channel_image[y_start:y_end, x_start:x_end]
-
-                        data_list.append(extracted_area.flatten())
-                            
-                    except Exception as e:
-                        self.info_label.config(text=f"Error processing channel {channel}: {e}")
-
-                # Save all the extracted channels to a file
-                df = pd.DataFrame(data_list).transpose()
-                df.columns=channels
-                df['class'] = self.class_entry.get()
-                print(df)
-                file_name = f"{self.file_name}_AREA{self.area_counter}_CLASS{self.class_entry.get()}_selected_area.xlsx"
-                file_path = f"{directory_path}/quadrants/{file_name}"
-                df.to_excel(file_path)
-                # np.save(file_path, extracted_area)
-                self.info_label.config(text="Selected areas saved for all channels!")
+                channels = self.tdms_blend.channels(scan_dir)
+
+                # Everything the export needs is captured now, the job itself runs on the worker thread
+                source = (self.file_path, self.tdms_blend)
+                x_start = max(self.start_x - self.rect_size // 2, 0)
+                y_start = max(self.start_y - self.rect_size // 2, 0)
+                rect_size = self.rect_size
+                class_label = self.class_entry.get()
+                export_format = self.export_format_var.get()
+                file_name = f"{self.file_name}_AREA{self.area_counter}_CLASS{class_label}_selected_area"
+
+                def export(job):
+                    names = []
+                    data_list = []
+                    for i, channel in enumerate(channels):
+                        job.check_cancelled()
+                        try:
+                            # Extract data for the channel
+                            channel_image = self.get_channel_image(channel, scan_dir, source)
+
+                            # Extract selected area for the channel
+                            extracted_area = channel_image[y_start:y_start + rect_size, x_start:x_start + rect_size]
+
+                            data_list.append(extracted_area.flatten())
+                            names.append(channel)
+                        except Exception as e:
+                            job.warn(f"Error processing channel {channel}: {e}")
+                        job.report(i + 1, len(channels))
+
+                    # Save all the extracted channels to a file
+                    file_path = write_columns(f"{directory_path}/quadrants/{file_name}", names, data_list,
+                                              export_format, class_label=class_label)
+                    print(f"Saved {file_path}")
+                    return "Selected areas saved for all channels!"
+
+                self.jobs.submit(f"Saving area {self.area_counter}", export)
             else:
                 self.info_label.config(text="Save operation canceled.")
         else:
             self.info_label.config(text="No area selected or no data loaded to save.")
 
+    @profiled
     def save_full(self):
         if self.image_data is not None and self.tdms_blend is not None:
             directory_path = self.directory#filedialog.askdirectory(initialdir=self.directory,title="Select Directory to Save Areas")
             if directory_path:
                 scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
-                data_list = []
-                for channel in channels:
-                    try:
-                        # Extract data for the channel
-                        channel_data = self.tdms_blend[scan_dir][channel].data
-                        data_list.append(channel_data)
-                            
-                    except Exception as e:
-                        self.info_label.config(text=f"Error processing channel {channel}: {e}")
-
-                # Save all the extracted channels to a file
-                df = pd.DataFrame(data_list).transpose()
-                df.columns=channels
-                print(df)
-                file_name = f"{self.file_name}_AREA{self.area_counter}_FULL.xlsx"
-                file_path = f"{directory_path}/quadrants/{file_name}"
-                df.to_excel(file_path)
-                # np.save(file_path, extracted_area)
-                self.info_label.config(text="Selected areas saved for all channels!")
+                channels = self.tdms_blend.channels(scan_dir)
+                source = (self.file_path, self.tdms_blend)
+                export_format = self.export_format_var.get()
+                file_name = f"{self.file_name}_AREA{self.area_counter}_FULL"
+
+                def channel_images(job):
+                    for i, channel in enumerate(channels):
+                        job.check_cancelled()
+                        try:
+                            # Channels not already cached are read without being cached
+                            file_path, scan = source
+                            channel_image = self.channel_cache.read(
+                                (file_path, scan_dir, channel),
+                                lambda: scan.read(channel, scan_dir),
+                            )
+                        except Exception as e:
+                            job.warn(f"Error processing channel {channel}: {e}")
+                            channel_image = None
+                        job.report(i + 1, len(channels))
+                        if channel_image is not None:
+                            yield channel, channel_image
+
+                def export(job):
+                    # Channels are spilled to disk one by one and written back in row blocks, so
+                    # no channel stack is held in memory
+                    file_path = stream_columns(f"{directory_path}/quadrants/{file_name}", channel_images(job),
+                                               export_format, job=job)
+                    print(f"Saved {file_path}")
+                    return "Full image saved for all channels!"
+
+                self.jobs.submit("Saving full image", export)
             else:
                 self.info_label.config(text="Save operation canceled.")
         else:
             self.info_label.config(text="No area selected or no data loaded to save.")
 
 
+    @profiled
+    def compute_tile_stats(self):
+        if self.image_data is not None and self.tdms_blend is not None:
+            try:
+                tile_size = int(self.size_entry.get())
+            except ValueError:
+                self.info_label.config(text="Invalid tile size.")
+                return
+            # Heatmap of the tile means of the shown channel, the next redraw removes it
+            stats = tile_stats(self.image_data, tile_size)
+            if stats["mean"].size == 0:
+                self.info_label.config(text="The image is smaller than one tile.")
+                return
+            draw_tile_heatmap(self.ax, stats["mean"], tile_size)
+            self.canvas.draw_idle()
+
+            # Stats of every tile of every channel, computed and saved on the worker thread
+            scan_dir = self.scan_dir_var.get()
+            channels = self.tdms_blend.channels(scan_dir)
+            source = (self.file_path, self.tdms_blend)
+            export_format = self.export_format_var.get()
+            file_base = f"{self.directory}/{self.file_name}_TILESTATS{tile_size}"
+
+            def export(job):
+                channel_stats = {}
+                for i, channel in enumerate(channels):
+                    job.check_cancelled()
+                    try:
+                        channel_image = self.get_channel_image(channel, scan_dir, source)
+                        channel_stats[channel] = (tile_origins(channel_image.shape, tile_size),
+                                                  tile_stats(channel_image, tile_size))
+                    except Exception as e:
+                        job.warn(f"Error processing channel {channel}: {e}")
+                    job.report(i + 1, len(channels))
+                names, columns = tile_stats_columns(channel_stats)
+                file_path = write_columns(file_base, names, columns, export_format)
+                print(f"Saved {file_path}")
+                return f"Tile stats saved for all channels: {os.path.basename(file_path)}"
+
+            self.jobs.submit(f"Computing {tile_size} px tile stats", export)
+        else:
+            self.info_label.config(text="No data loaded to compute tile stats.")
+
     def compute_stats(self):
         if self.extracted_area is not None:
             mean_value = np.mean(self.extracted_area)
@@ -4,7 +4,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from nptdms import TdmsFile
+import os
 from dr_pnas.extraction import *
+from readers import open_scan
+from channel_cache import ChannelCache, DEFAULT_CACHE_BYTES
+from interaction import BlitManager, InteractionDispatcher
+from display import StatsCache, PyramidCache, draw_tile_heatmap
+from exporters import DEFAULT_TABLE_FORMAT, TableWriter, write_columns
+from background import JobPanel
+from tiling import tile_origins, tile_stats, tile_stats_columns
+from profiler import PROFILER, profiled
+from surfparams import cached_parameters, compute_regions, tile_regions
+from result_cache import ResultCache
+import multiprocessing
 
 class ImageSelectorApp:
     def __init__(self, root):
@@ -25,9 +37,15 @@ class ImageSelectorApp:
         self.stats_button = tk.Button(button_frame, text="Compute Stats", command=self.compute_stats)
         self.stats_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.tile_stats_button = tk.Button(button_frame, text="Tile Stats", command=self.compute_tile_stats)
+        self.tile_stats_button.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.stats_button = tk.Button(button_frame, text="Compute Parameters", command=self.compute_surf_params)
         self.stats_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.tile_params_button = tk.Button(button_frame, text="Tile Parameters", command=self.compute_tile_params)
+        self.tile_params_button.pack(side=tk.LEFT, padx=5, pady=5)
+
         # Dropdown for scan direction
         self.scan_dir_label = tk.Label(root, text="Select Scan Direction:")
         self.scan_dir_label.pack()
@@ -68,10 +86,16 @@ class ImageSelectorApp:
         self.stats_label = tk.Label(root, text="")
         self.stats_label.pack()
 
+        # Exports run on a worker thread, the progress is polled from the Tk loop
+        self.jobs = JobPanel(root, self.info_label)
+
         self.figure, (self.ax, self.ax_sub) = plt.subplots(1, 2, figsize=(10, 5))
         self.canvas = FigureCanvasTkAgg(self.figure, master=root)
         self.canvas_widget = self.canvas.get_tk_widget()
         self.canvas_widget.pack()
+        self.blit_manager = BlitManager(self.canvas)
+        # Mouse handlers are connected once here, show_image only redraws
+        self.dispatcher = InteractionDispatcher(self.canvas, tool=self)
 
         self.image_data = None
         self.physical_dimensions = 10  # Default physical dimensions
@@ -81,25 +105,94 @@ class ImageSelectorApp:
         self.rect_size = 20  # Fixed size of the rectangle
         self.is_dragging = False
         self.extracted_area = None
-        self.tdms_blend = None  # Store the TDMS file object
+        self.tdms_blend = None  # Reader of the loaded scan (readers.py)
+        self.file_path = None
+        self.load_job = None  # Background load in progress
+        self.channel_cache = ChannelCache(max_bytes=DEFAULT_CACHE_BYTES)  # Decoded channels shared by display and export
+        self.stats_cache = StatsCache()  # Display range and stats of every shown channel
+        self.pyramid_cache = PyramidCache()  # Downsampled levels used to draw large scans
+        self.params_cache = ResultCache()  # Surface parameters of previous computations, kept on disk
+        self.image_key = None
+        self.lazy_loading = True  # Only read the TDMS metadata on load, channels are decoded on demand
         self.sh = None
+        self.directory = None
+        self.file_name = None
 
+    @profiled
     def load_data(self):
-        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("All files", "*.*")])
+        file_path = filedialog.askopenfilename(filetypes=[("TDMS files", "*.tdms"), ("NumPy arrays", "*.npy *.npz"), ("All files", "*.*")])
         if file_path:
-            try:
-                self.tdms_blend = TdmsFile.read(file_path)
-                scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
+            # The file is parsed on the loader thread, the channel dropdown is filled as soon as
+            # the channel names are known and the image is shown once its data is decoded
+            self.channel_dropdown.config(state="disabled")
+            self.channel_cache.clear()
+            self.stats_cache.clear()
+            self.pyramid_cache.clear()
+            lazy = self.lazy_loading
+            scan_dir = self.scan_dir_var.get()
+            selected = self.channel_var.get()
+
+            def load(job):
+                scan = open_scan(file_path, lazy=lazy)
+                job.source = (file_path, scan)
+                channels = scan.channels(scan_dir)
+                if not channels:
+                    raise ValueError("no channels found")
+                job.post(self.on_file_opened, job, channels)
+                channel = selected if selected in channels else channels[0]
+                self.channel_cache.get(
+                    (file_path, scan_dir, channel),
+                    lambda: scan.read(channel, scan_dir, job),
+                )
+
+            self.load_job = self.jobs.load(f"Loading {os.path.basename(file_path)}", load, on_done=self.on_file_loaded)
+
+    def on_file_opened(self, job, channels):
+        if job is not self.load_job or job.cancelled:
+            return
+        job.installed = True
+        self.close_file()
+        self.file_path, self.tdms_blend = job.source
+        self.directory, self.file_name = os.path.split(self.file_path)
+
+        # Populate channel dropdown
+        self.channel_dropdown['values'] = channels
+        self.channel_dropdown.config(state="readonly")
+        if self.channel_var.get() not in channels:
+            self.channel_var.set(channels[0])
+        self.info_label.config(text=f"{len(channels)} channels found, decoding the image...")
+
+    def on_file_loaded(self, job):
+        if job is not self.load_job:
+            # Replaced by a newer load, its file was never shown
+            if job.source is not None and not job.installed:
+                self.discard_source(job.source)
+            return
+        self.load_job = None
+        if job.cancelled or job.error is not None:
+            if job.installed:
+                self.close_file()
+                self.image_data = None
+                self.channel_dropdown['values'] = []
+            elif job.source is not None:
+                self.discard_source(job.source)
+            self.channel_dropdown.config(state="readonly")
+            if job.cancelled:
+                self.info_label.config(text="File loading cancelled.")
+            else:
+                self.info_label.config(text=f"Error loading file: {job.error}")
+        else:
+            self.update_image()
 
-                # Populate channel dropdown
-                self.channel_dropdown['values'] = channels
-                if not self.channel_var.get():
-                    self.channel_var.set(channels[0])
+    def discard_source(self, source):
+        source[1].close()
 
-                self.update_image()
-            except Exception as e:
-                self.info_label.config(text=f"Error loading file: {e}")
+    def close_file(self):
+        if self.tdms_blend is not None:
+            # Queued exports may still read the previous file, close it after them
+            previous_file = self.tdms_blend
+            self.jobs.worker.after_queued(previous_file.close)
+        self.tdms_blend = None
 
     def update_physical_dimensions(self, *args):
         try:
@@ -108,37 +201,57 @@ class ImageSelectorApp:
         except ValueError:
             self.info_label.config(text="Invalid physical dimensions value!")
 
+    def get_channel_image(self, channel, scan_dir=None, source=None):
+        # Background jobs pass the (file_path, scan) they were queued with
+        file_path, scan = source or (self.file_path, self.tdms_blend)
+        scan_dir = scan_dir or self.scan_dir_var.get()
+        return self.channel_cache.get(
+            (file_path, scan_dir, channel),
+            lambda: scan.read(channel, scan_dir),
+        )
+
+    def get_image_stats(self):
+        return self.stats_cache.get(self.image_key, self.image_data)
+
+    def get_display_image(self):
+        # Level matching the size of the axes on screen, full resolution is kept for the
+        # selected area and the exports
+        bbox = self.ax.get_window_extent()
+        pyramid = self.pyramid_cache.get(self.image_key, self.image_data)
+        level, _ = pyramid.level_for(self.image_data, bbox.width, bbox.height)
+        return level
+
+    @profiled
     def update_image(self, event=None):
         if self.tdms_blend is not None:
             try:
                 scan_dir = self.scan_dir_var.get()
                 channel = self.channel_var.get()
                 if scan_dir and channel:
-                    tmp = self.tdms_blend[scan_dir][channel].data
-                    self.sh = int(np.sqrt(tmp.shape[0]))
-                    self.image_data = tmp.reshape(self.sh, self.sh)
+                    self.image_data = self.get_channel_image(channel, scan_dir)
+                    self.image_key = (self.file_path, scan_dir, channel)
+                    self.sh = self.image_data.shape[0]
 
                     self.show_image()
 
                     # Compute and display stats for the entire image
-                    mean_value = np.mean(self.image_data)
-                    std_dev = np.std(self.image_data)
-                    self.stats_label.config(text=f"Full Image Stats - Mean: {mean_value:.2f}, Std Dev: {std_dev:.2f}")
+                    stats = self.get_image_stats()
+                    self.stats_label.config(text=f"Full Image Stats - Mean: {stats.mean:.2f}, Std Dev: {stats.std:.2f}")
             except Exception as e:
                 self.info_label.config(text=f"Error updating image: {e}")
 
+    @profiled
     def show_image(self):
         if self.image_data is not None:
             self.ax.clear()
-            self.ax.imshow(self.image_data, cmap='YlOrBr_r')
+            h, w = self.image_data.shape
+            # The extent keeps the axes in full resolution pixels whatever level is drawn
+            self.ax.imshow(self.get_display_image(), cmap='YlOrBr_r', extent=(-0.5, w - 0.5, h - 0.5, -0.5))
             self.ax.set_title("Drag to select an area")
             self.ax_sub.clear()
             self.ax_sub.set_title("Selected Area")
-            self.canvas.draw()
-
-            self.canvas.mpl_connect("button_press_event", self.on_press)
-            self.canvas.mpl_connect("motion_notify_event", self.on_drag)
-            self.canvas.mpl_connect("button_release_event", self.on_release)
+            with PROFILER.span("draw"):
+                self.canvas.draw()
 
     def on_press(self, event):
         if event.inaxes == self.ax:
@@ -166,7 +279,7 @@ class ImageSelectorApp:
                     facecolor="none",
                 )
             )
-            self.canvas.draw()
+            self.blit_manager.start(self.rect)
 
     def on_drag(self, event):
         if self.is_dragging and event.inaxes == self.ax:
@@ -175,13 +288,15 @@ class ImageSelectorApp:
 
             if self.rect:
                 self.rect.set_xy((self.start_x - self.rect_size // 2, self.start_y - self.rect_size // 2))
-            self.canvas.draw()
+            self.blit_manager.request_update()
 
     def on_release(self, event):
         if self.is_dragging:
             self.is_dragging = False
+            self.blit_manager.stop()
             self.extract_area()
 
+    @profiled
     def extract_area(self):
         if self.image_data is not None:
             x_start = max(self.start_x - self.rect_size // 2, 0)
@@ -200,48 +315,95 @@ class ImageSelectorApp:
                 self.ax_sub.clear()
                 self.ax_sub.imshow(self.extracted_area, cmap='YlOrBr_r')
                 self.ax_sub.set_title("Selected Area")
-                self.canvas.draw()
+                self.canvas.draw_idle()
             else:
                 self.info_label.config(text="Selected area is out of bounds!")
 
+    @profiled
     def save_area(self):
         if self.image_data is not None and self.tdms_blend is not None:
             directory_path = filedialog.askdirectory(title="Select Directory to Save Areas")
             if directory_path:
                 scan_dir = self.scan_dir_var.get()
-                channels = list(self.tdms_blend[scan_dir]._channels.keys())
-
-                for channel in channels:
-                    try:
-                        # Extract data for the channel
-                        channel_data = self.tdms_blend[scan_dir][channel].data
-                        sh = int(np.sqrt(channel_data.shape[0]))
-                        channel_image = channel_data.reshape(sh, sh)
-
-                        # Extract selected area for the channel
-                        x_start = max(self.start_x - self.rect_size // 2, 0)
-                        y_start = max(self.start_y - self.rect_size // 2, 0)
-                        x_end = min(x_start + self.rect_size, channel_image.shape[1])
-                        y_end = min(y_start + self.rect_size, channel_image.shape[0])
-
-                        extracted_area = channel_image[y_start:y_end, x_start:x_end]
-
-                        if extracted_area.shape == (self.rect_size, self.rect_size):
-                            # Save the extracted area to a file
-                            file_name = f"{channel}_selected_area.npy"
-                            file_path = f"{directory_path}/{file_name}"
-                            np.save(file_path, extracted_area)
-                        else:
-                            self.info_label.config(text=f"Selected area out of bounds for channel: {channel}")
-                    except Exception as e:
-                        self.info_label.config(text=f"Error processing channel {channel}: {e}")
-
-                self.info_label.config(text="Selected areas saved for all channels!")
+                channels = self.tdms_blend.channels(scan_dir)
+
+                # Everything the export needs is captured now, the job itself runs on the worker thread
+                source = (self.file_path, self.tdms_blend)
+                x_start = max(self.start_x - self.rect_size // 2, 0)
+                y_start = max(self.start_y - self.rect_size // 2, 0)
+                rect_size = self.rect_size
+
+                def export(job):
+                    for i, channel in enumerate(channels):
+                        job.check_cancelled()
+                        try:
+                            # Extract data for the channel
+                            channel_image = self.get_channel_image(channel, scan_dir, source)
+
+                            # Extract selected area for the channel
+                            extracted_area = channel_image[y_start:y_start + rect_size, x_start:x_start + rect_size]
+
+                            if extracted_area.shape == (rect_size, rect_size):
+                                # Save the extracted area to a file
+                                file_name = f"{channel}_selected_area.npy"
+                                file_path = f"{directory_path}/{file_name}"
+                                np.save(file_path, extracted_area)
+                            else:
+                                job.warn(f"Selected area out of bounds for channel: {channel}")
+                        except Exception as e:
+                            job.warn(f"Error processing channel {channel}: {e}")
+                        job.report(i + 1, len(channels))
+                    return "Selected areas saved for all channels!"
+
+                self.jobs.submit("Saving area", export)
             else:
                 self.info_label.config(text="Save operation canceled.")
         else:
             self.info_label.config(text="No area selected or no data loaded to save.")
 
+    @profiled
+    def compute_tile_stats(self):
+        if self.image_data is not None and self.tdms_blend is not None:
+            try:
+                tile_size = int(self.size_entry.get())
+            except ValueError:
+                self.info_label.config(text="Invalid tile size.")
+                return
+            # Heatmap of the tile means of the shown channel, the next redraw removes it
+            stats = tile_stats(self.image_data, tile_size)
+            if stats["mean"].size == 0:
+                self.info_label.config(text="The image is smaller than one tile.")
+                return
+            draw_tile_heatmap(self.ax, stats["mean"], tile_size)
+            self.canvas.draw_idle()
+
+            # Stats of every tile of every channel, computed and saved on the worker thread
+            scan_dir = self.scan_dir_var.get()
+            channels = self.tdms_blend.channels(scan_dir)
+            source = (self.file_path, self.tdms_blend)
+            export_format = DEFAULT_TABLE_FORMAT
+            file_base = f"{self.directory}/{self.file_name}_TILESTATS{tile_size}"
+
+            def export(job):
+                channel_stats = {}
+                for i, channel in enumerate(channels):
+                    job.check_cancelled()
+                    try:
+                        channel_image = self.get_channel_image(channel, scan_dir, source)
+                        channel_stats[channel] = (tile_origins(channel_image.shape, tile_size),
+                                                  tile_stats(channel_image, tile_size))
+                    except Exception as e:
+                        job.warn(f"Error processing channel {channel}: {e}")
+                    job.report(i + 1, len(channels))
+                names, columns = tile_stats_columns(channel_stats)
+                file_path = write_columns(file_base, names, columns, export_format)
+                print(f"Saved {file_path}")
+                return f"Tile stats saved for all channels: {os.path.basename(file_path)}"
+
+            self.jobs.submit(f"Computing {tile_size} px tile stats", export)
+        else:
+            self.info_label.config(text="No data loaded to compute tile stats.")
+
     def compute_stats(self):
         if self.extracted_area is not None:
             mean_value = np.mean(self.extracted_area)
@@ -251,25 +413,65 @@ class ImageSelectorApp:
         else:
             self.info_label.config(text="No area selected to compute stats.")
 
+    @profiled
     def compute_surf_params(self):
         if self.extracted_area is not None:
-            dx = (self.physical_dimensions*1000)/self.sh
-            #print(dx, self.physical_dimensions, self.sh)
-            params = extract_parameters(self.extracted_area,dx,dx,self.rect_size,fitted=False)
-            #print("Params:", params)
-            # Convert parameters to a DataFrame for saving
-            params_df = pd.DataFrame.from_dict(params, orient='index', columns=['Value'])
-
-            # Save to an Excel file
+            # Ask for the file first, the computation and the writing run on the worker thread
             file_path = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")])
             if file_path:
-                params_df.to_excel(file_path, index=True)
-                self.info_label.config(text="Surface parameters saved successfully!")
+                extracted_area = self.extracted_area
+                dx = (self.physical_dimensions*1000)/self.sh
+                rect_size = self.rect_size
+
+                def compute(job):
+                    job.report(0, 1)
+                    #print(dx, self.physical_dimensions, self.sh)
+                    with PROFILER.span("extract_parameters", extracted_area.nbytes):
+                        params = cached_parameters(self.params_cache, extracted_area, dx, rect_size, fitted=False)
+                    #print("Params:", params)
+                    job.check_cancelled()
+                    # Convert parameters to a DataFrame for saving
+                    with PROFILER.span("build_dataframe"):
+                        params_df = pd.DataFrame.from_dict(params, orient='index', columns=['Value'])
+
+                    # Save to an Excel file
+                    with PROFILER.span("write_excel"):
+                        params_df.to_excel(file_path, index=True)
+                    job.report(1, 1)
+                    return f"Surface parameters saved successfully! (cache hit rate {self.params_cache.hit_rate:.0%})"
+
+                self.jobs.submit("Computing surface parameters", compute)
             else:
                 self.info_label.config(text="Save operation canceled.")
         else:
             self.info_label.config(text="No area selected to compute surface parameters.")
 
+    def compute_tile_params(self):
+        if self.image_data is not None:
+            # Parameters of every tile of the shown channel at the rectangle size, on a process pool
+            # fed by the worker thread, streamed into one table
+            image_data = self.image_data
+            tile_size = self.rect_size
+            dx = (self.physical_dimensions*1000)/self.sh
+            region = {"file": self.file_name, "channel": self.channel_var.get()}
+            file_base = f"{self.directory}/{self.file_name}_SURFPARAMS{tile_size}"
+            n_tiles = len(tile_origins(image_data.shape, tile_size))
+
+            def compute(job):
+                regions = (item + (dx,) for item in tile_regions(image_data, region, tile_size))
+                with TableWriter(file_base, DEFAULT_TABLE_FORMAT) as writer:
+                    # Forked workers would inherit the Tk state, start fresh interpreters instead
+                    n_done, n_failed, elapsed = compute_regions(regions, writer, job=job, total=n_tiles,
+                                                                mp_context=multiprocessing.get_context("spawn"),
+                                                                cache=self.params_cache)
+                print(f"Saved {writer.file_path}")
+                return (f"Parameters of {n_done} tiles saved ({n_done / elapsed:.1f} regions/s, "
+                        f"cache hit rate {self.params_cache.hit_rate:.0%}): {os.path.basename(writer.file_path)}")
+
+            self.jobs.submit(f"Computing {tile_size} px tile parameters", compute)
+        else:
+            self.info_label.config(text="No data loaded to compute tile parameters.")
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = ImageSelectorApp(root)
@@ -0,0 +1,144 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Set to the path of a Chrome trace file (chrome://tracing, Perfetto) to turn profiling on:
+#   SELECTOR_PROFILE=trace.json python main.py
+PROFILE_ENV = "SELECTOR_PROFILE"
+
+
+class Span:
+    # Timed region. bytes can be added while it runs, the children durations and bytes are
+    # summed per name for the status bar summary
+    def __init__(self, profiler, name, nbytes=0, args=None):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+        self.args = args or {}
+        self.children = {}
+        self.start = None
+        self.duration = None
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.profiler._stack().append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter_ns() - self.start
+        if not self.nbytes:
+            # Spans without their own count, like the app methods, report what their children processed
+            self.nbytes = sum(nbytes for _, nbytes in self.children.values())
+        stack = self.profiler._stack()
+        stack.pop()
+        if stack:
+            parent = stack[-1]
+            duration, nbytes = parent.children.get(self.name, (0, 0))
+            parent.children[self.name] = (duration + self.duration, nbytes + self.nbytes)
+        self.profiler._record(self, root=not stack)
+        return False
+
+
+class NullSpan:
+    # Returned while profiling is off, so instrumented code never checks
+    nbytes = 0
+
+    def add_bytes(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.enabled = trace_path is not None
+        self.events = []
+        self.last_root = None
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = {}
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def span(self, name, nbytes=0, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, nbytes, args)
+
+    def _record(self, span, root):
+        thread = threading.current_thread()
+        event = {
+            "name": span.name,
+            "cat": "root" if root else "op",
+            "ph": "X",
+            "ts": span.start / 1000,
+            "dur": span.duration / 1000,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": dict(span.args, bytes=span.nbytes),
+        }
+        with self.lock:
+            self.events.append(event)
+            self._threads[thread.ident] = thread.name
+            if root:
+                self.last_root = span
+
+    def summary(self):
+        # Last finished top level span and where its time went, e.g.
+        # "Saving area 1: 412 ms, 64.0 MB (decode 301 ms, write_parquet 88 ms)"
+        span = self.last_root
+        if span is None:
+            return ""
+        text = f"{span.name}: {span.duration / 1e6:.0f} ms"
+        if span.nbytes:
+            text += f", {span.nbytes / 1024 ** 2:.1f} MB"
+        children = sorted(span.children.items(), key=lambda item: -item[1][0])[:3]
+        if children:
+            text += " (" + ", ".join(f"{name} {duration / 1e6:.0f} ms" for name, (duration, _) in children) + ")"
+        return text
+
+    def write(self, trace_path=None):
+        trace_path = trace_path or self.trace_path
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        with open(trace_path, "w") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+        return trace_path
+
+
+PROFILER = Profiler(os.environ.get(PROFILE_ENV) or None)
+if PROFILER.enabled:
+    atexit.register(PROFILER.write)
+
+
+def profiled(func):
+    # Method decorator, one span per call named after the method
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            return func(*args, **kwargs)
+        with PROFILER.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
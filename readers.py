@@ -0,0 +1,488 @@
+import contextlib
+import json
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from nptdms import TdmsFile
+
+# Values read at a time when a TDMS channel is decoded by a background job
+TDMS_CHUNK_SIZE = 1 << 18
+TDMS_EXTENSIONS = (".tdms",)
+NUMPY_EXTENSIONS = (".npy", ".npz")
+# TDMS properties holding the image size, looked up on the channel, then its group, then the file
+TDMS_ROWS_PROPERTIES = ("Number of lines", "Lines", "Rows", "ny")
+TDMS_COLUMNS_PROPERTIES = ("Samps/line", "Points", "Pixels", "Columns", "nx")
+# Decoded channels an export may have waiting ahead of it, and threads decoding Bruker layers
+READ_AHEAD_BYTES = 256 * 1024 ** 2
+DECODE_WORKERS = min(8, os.cpu_count() or 1)
+# Rows scaled at a time when a Bruker channel is decoded by a background job
+BRUKER_CHUNK_ROWS = 256
+BRUKER_DTYPES = {2: "<i2", 4: "<i4", 8: "<i8"}
+# Per-directory index of the Bruker headers, keyed by file name, size and modification time.
+# Bump the version when the entries change.
+BRUKER_INDEX_NAME = ".bruker_index.sqlite"
+BRUKER_INDEX_VERSION = 3
+
+
+def open_tdms(file_path, lazy=True):
+    # TdmsFile.open only reads the metadata, a channel is decoded the first time it is accessed
+    if lazy:
+        return TdmsFile.open(file_path)
+    return TdmsFile.read(file_path)
+
+
+def tdms_property(objects, names):
+    for obj in objects:
+        for name in names:
+            if name in obj.properties:
+                return int(obj.properties[name])
+    return None
+
+
+def tdms_shape(tdms_file, scan_dir, channel):
+    # From the header only: the value count is metadata, the data is not read
+    channel_obj = tdms_file[scan_dir][channel]
+    n = len(channel_obj)
+    objects = (channel_obj, tdms_file[scan_dir], tdms_file)
+    rows = tdms_property(objects, TDMS_ROWS_PROPERTIES)
+    cols = tdms_property(objects, TDMS_COLUMNS_PROPERTIES)
+    if rows is None and cols is None:
+        # Scans without size properties are square
+        sh = int(round(np.sqrt(n)))
+        if sh * sh != n:
+            raise ValueError(f"{channel}: {n} values is not a square image and the file has no size properties")
+        return sh, sh
+    rows = rows or n // cols
+    cols = cols or n // rows
+    if rows * cols != n:
+        raise ValueError(f"{channel}: {n} values do not fit a {rows}x{cols} image")
+    return rows, cols
+
+
+def read_tdms_image(tdms_file, scan_dir, channel, job=None):
+    channel_obj = tdms_file[scan_dir][channel]
+    shape = tdms_shape(tdms_file, scan_dir, channel)
+    if job is None:
+        # channel[:] works for opened and fully read files alike, .data only for the latter
+        channel_data = channel_obj[:]
+    else:
+        # Read in chunks so a background load can report progress and be cancelled
+        n = len(channel_obj)
+        channel_data = np.empty(n, dtype=channel_obj.dtype)
+        for offset in range(0, n, TDMS_CHUNK_SIZE):
+            job.check_cancelled()
+            channel_data[offset:offset + TDMS_CHUNK_SIZE] = channel_obj.read_data(offset, TDMS_CHUNK_SIZE)
+            job.report(min(offset + TDMS_CHUNK_SIZE, n), n)
+    return channel_data.reshape(shape)
+
+
+class BrukerFile:
+    # Nanoscope header parsed the way pySPM.Bruker does, into the same `layers` and `scanners`
+    # dicts, without reading the data. The layers are then views of one memory map of the file.
+    def __init__(self, path):
+        self.path = path
+        self.layers = []
+        self.scanners = []
+        with open(path, "rb") as file:
+            mode = ""
+            while True:
+                raw_line = file.readline()
+                if not raw_line:
+                    raise ValueError(f"{path}: no '*File list end' in the header, not a Nanoscope file")
+                line = raw_line.rstrip().replace(b"\\", b"")
+                if line == b"*Ciao image list":
+                    self.layers.append({})
+                    mode = "Image"
+                elif line == b"*Scanner list":
+                    self.scanners.append({})
+                    mode = "Scanner"
+                elif line.startswith(b"*EC"):
+                    mode = "EC"
+                else:
+                    args = line.split(b": ")
+                    if len(args) > 1:
+                        if mode == "Image":
+                            self.layers[-1][args[0]] = args[1:]
+                        elif mode == "Scanner":
+                            self.scanners[-1][args[0]] = args[1:]
+                    if line == b"*File list end":
+                        break
+        self._data = None
+
+    def layer_value(self, i, name):
+        # Header keys are spelled with varying case between Nanoscope versions
+        for key in (name, name.lower(), name[0] + name[1:].lower()):
+            if key.encode() in self.layers[i]:
+                return self.layers[i][key.encode()][0]
+        raise KeyError(f"{name} not in layer {i}")
+
+    def _get_res(self, i):
+        # (columns, rows): a scan is "Number of lines" lines of "Samps/line" samples. pySPM pairs
+        # "Valid data len X" with "Number of lines", which transposes rectangular scans.
+        layer = self.layers[i]
+        cols = self.layer_value(i, "Valid data len X" if b"Valid data len X" in layer else "Samps/line")
+        rows = self.layer_value(i, "Valid data len Y" if b"Valid data len Y" in layer else "Number of lines")
+        return int(cols), int(rows)
+
+    def layer_scale(self, i):
+        # (scale, scale2) taking the raw integers to physical units, as in pySPM.Bruker.get_channel
+        var = self.layer_value(i, "@2:Z scale").decode("latin1")
+        bpp = int(self.layer_value(i, "Bytes/pixel"))
+        if "[" in var:
+            sensitivity, value, _ = re.match(
+                r"[A-Z]+\s+\[([^]]+)]\s+\(-?[0-9.]+ .*?\)\s+(-?[0-9.]+)\s+(.*?)$", var).groups()
+            scale2 = float(self.scanners[0][b"@" + sensitivity.encode("latin1")][0].split()[1])
+            return float(value) / 256 ** bpp, scale2
+        value = re.match(r"[A-Z]+ \(-?[0-9.]+ [^)]+\)\s+(-?[0-9.]+) [\w]+", var).groups()[0]
+        return float(value) / 65536.0, 1
+
+    def layer_info(self, i):
+        # Everything needed to read a layer without the header
+        offset = int(self.layer_value(i, "Data offset"))
+        cols, rows = self._get_res(i)
+        try:
+            scale = list(self.layer_scale(i))
+        except (KeyError, AttributeError, ValueError):
+            # Reading the channel fails, not opening the file
+            scale = None
+        scan_size = None
+        with contextlib.suppress(KeyError):
+            scan_size = self.layer_value(i, "Scan Size").decode("latin1")
+        return {
+            "layer": i,
+            "offset": offset,
+            "shape": [rows, cols],
+            "bpp": int(self.layer_value(i, "Data length")) // (rows * cols),
+            "scale": scale,
+            "scan_size": scan_size,
+        }
+
+    def raw_layer(self, i):
+        # Integers of a layer as stored, a read-only view of the mapped file
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return map_layer(self._data, self.layer_info(i))
+
+
+def map_layer(data, info):
+    rows, cols = info["shape"]
+    offset, bpp = info["offset"], info["bpp"]
+    return data[offset:offset + rows * cols * bpp].view(BRUKER_DTYPES[bpp]).reshape(rows, cols)
+
+
+def bruker_layer_name(layer):
+    with contextlib.suppress(KeyError):
+        temp = layer[b"@2:Image Data"][0].decode("latin1")
+        pattern = r'"(.*?)"'
+        match = re.search(pattern, temp)
+        return match.group(1)
+    return None
+
+
+def bruker_channel_names(scan):
+    # Trace and retrace layers share their name and are read as one channel (bruker_layer_names),
+    # so every name is listed once, in file order
+    chans = []
+    for layer in scan.layers:
+        name = bruker_layer_name(layer)
+        if name is not None and name not in chans:
+            chans.append(name)
+    return chans
+
+
+def bruker_layer_names(scan):
+    # {channel name: layer index}. get_channel() reads the first trace layer of a channel and
+    # falls back on its retrace layer, the shape is taken from the same one.
+    names = {}
+    for i, layer in enumerate(scan.layers):
+        name = bruker_layer_name(layer)
+        if name is None:
+            continue
+        retrace = layer.get(b"Line Direction", [b""])[0] == b"Retrace"
+        if name not in names or (not retrace and names[name][1]):
+            names[name] = (i, retrace)
+    return {name: i for name, (i, _) in names.items()}
+
+
+_decode_pool = None
+
+
+def decode_pool():
+    # One pool for the whole session. Scaling a mapped layer is a numpy operation that runs
+    # without the GIL, threads are enough.
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+    return _decode_pool
+
+
+def bruker_index_entry(scan):
+    # Channel names in header order and {name: layer_info} of the layer each one is read from
+    layers = bruker_layer_names(scan)
+    return {
+        "channels": bruker_channel_names(scan),
+        "layers": {name: scan.layer_info(i) for name, i in layers.items()},
+    }
+
+
+def _bruker_index(file_path):
+    directory, name = os.path.split(os.path.abspath(file_path))
+    stat = os.stat(file_path)
+    connection = sqlite3.connect(os.path.join(directory, BRUKER_INDEX_NAME), timeout=5)
+    connection.execute("CREATE TABLE IF NOT EXISTS scans (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                       "version INTEGER, entry TEXT)")
+    return connection, (name, stat.st_size, stat.st_mtime_ns, BRUKER_INDEX_VERSION)
+
+
+def bruker_index_lookup(file_path):
+    # The indexed entry of a file, None when it is missing or the file changed since
+    try:
+        connection, key = _bruker_index(file_path)
+        with contextlib.closing(connection):
+            row = connection.execute("SELECT entry FROM scans WHERE name = ? AND size = ? AND mtime_ns = ? "
+                                     "AND version = ?", key).fetchone()
+    except (OSError, sqlite3.Error):
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def bruker_index_store(file_path, entry):
+    # Read-only or shared directories without write access simply get no index
+    try:
+        connection, key = _bruker_index(file_path)
+        with contextlib.closing(connection), connection:
+            connection.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?)", key + (json.dumps(entry),))
+    except (OSError, sqlite3.Error):
+        pass
+
+
+class ReadAhead:
+    # Reader handed to an export loop: the channels it is going to ask for, in that order, are
+    # decoded on a pool ahead of it, keeping at most `window` decoded channels waiting. Without
+    # a pool it reads straight from the reader.
+    def __init__(self, reader, channels, scan_dir=None, submit=None, window=1):
+        self.reader = reader
+        self.scan_dir = scan_dir
+        self.submit = submit
+        self.window = max(1, window)
+        self.queue = list(channels)
+        self.futures = {}
+        self.fill()
+
+    def fill(self):
+        while self.submit is not None and self.queue and len(self.futures) < self.window:
+            channel = self.queue.pop(0)
+            self.futures[channel] = self.submit(channel)
+
+    def read(self, channel, scan_dir=None, job=None):
+        future = self.futures.pop(channel, None)
+        if future is None:
+            if channel in self.queue:
+                self.queue.remove(channel)
+            return self.reader.read(channel, scan_dir, job)
+        self.fill()
+        return future.result()
+
+    def close(self):
+        # Channels the export did not get to (cancelled, failed) are dropped
+        self.queue = []
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class ScanReader:
+    # Same interface for every scan format: channel names per scan direction and 2D images.
+    # read() hands out the decoded or memory-mapped data itself (reshaped views, no copies),
+    # callers must not write into it.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.scan_dirs = [None]
+
+    def channels(self, scan_dir=None):
+        raise NotImplementedError
+
+    def read(self, channel, scan_dir=None, job=None):
+        raise NotImplementedError
+
+    def shape(self, channel, scan_dir=None):
+        # (rows, columns) of a channel from the file header, without reading its data
+        raise NotImplementedError
+
+    def iter_channels(self, scan_dir=None):
+        # Lazy channel stack, each image is only read when the loop gets to it
+        for channel in self.channels(scan_dir):
+            yield channel, self.read(channel, scan_dir)
+
+    def read_ahead(self, channels, scan_dir=None, max_bytes=READ_AHEAD_BYTES):
+        # Formats whose channels are cheap to read (memory-mapped) or that hold an open file
+        # are read in the caller's loop
+        return ReadAhead(self, channels, scan_dir)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class TdmsReader(ScanReader):
+    def __init__(self, file_path, lazy=True):
+        super().__init__(file_path)
+        self.file = open_tdms(file_path, lazy)
+        self.scan_dirs = [group.name for group in self.file.groups()]
+
+    def channels(self, scan_dir=None):
+        return list(self.file[scan_dir]._channels.keys())
+
+    def read(self, channel, scan_dir=None, job=None):
+        return read_tdms_image(self.file, scan_dir, channel, job)
+
+    def shape(self, channel, scan_dir=None):
+        return tdms_shape(self.file, scan_dir, channel)
+
+    def close(self):
+        self.file.close()
+
+
+class BrukerReader(ScanReader):
+    # Bruker channels are not split by scan direction, scan_dir is ignored.
+    # Opening only looks the file up in the directory index, the text header is parsed the
+    # first time a file is seen (or after it changed). A channel is scaled from the mapped
+    # integers when it is read, with the same arithmetic as pySPM.
+    def __init__(self, file_path, use_index=True):
+        super().__init__(file_path)
+        self._scan = None
+        self._data = None
+        self.index = bruker_index_lookup(file_path) if use_index else None
+        if self.index is None:
+            self.index = bruker_index_entry(self.scan)
+            if use_index:
+                bruker_index_store(file_path, self.index)
+        self._channels = self.index["channels"]
+        self._layers = self.index["layers"]
+
+    @property
+    def scan(self):
+        # Full header, only parsed when the index is not enough
+        if self._scan is None:
+            self._scan = BrukerFile(self.file_path)
+        return self._scan
+
+    def channels(self, scan_dir=None):
+        return list(self._channels)
+
+    def raw(self, channel):
+        if self._data is None:
+            self._data = np.memmap(self.file_path, dtype=np.uint8, mode="r")
+        return map_layer(self._data, self._layers[channel])
+
+    def read(self, channel, scan_dir=None, job=None):
+        raw = self.raw(channel)
+        if self._layers[channel]["scale"] is None:
+            raise ValueError(f"{channel}: no Z scale in the header")
+        scale, scale2 = self._layers[channel]["scale"]
+        image = np.empty(raw.shape, dtype=np.float64)
+        step = BRUKER_CHUNK_ROWS if job is not None else len(raw)
+        for row in range(0, len(raw), max(step, 1)):
+            if job is not None:
+                job.check_cancelled()
+            block = image[row:row + step]
+            np.multiply(raw[row:row + step], scale, out=block)
+            block *= scale2
+            if job is not None:
+                job.report(min(row + step, len(raw)), len(raw))
+        return image
+
+    def shape(self, channel, scan_dir=None):
+        # "Number of lines" rows of "Samps/line" values
+        return tuple(self._layers[channel]["shape"])
+
+    def read_ahead(self, channels, scan_dir=None, max_bytes=READ_AHEAD_BYTES):
+        # Layers are scaled in parallel to float64
+        if len(channels) < 2 or DECODE_WORKERS < 2:
+            return ReadAhead(self, channels, scan_dir)
+        rows, cols = self.shape(channels[0])
+        pool = decode_pool()
+        return ReadAhead(self, channels, scan_dir, lambda channel: pool.submit(self.read, channel, scan_dir),
+                         max_bytes // (rows * cols * 8))
+
+
+class NumpyReader(ScanReader):
+    # .npy files are memory-mapped: a 2D image is one channel named after the file, a (C, H, W)
+    # stack has one channel per plane, named from the _channels.txt written next to stack exports.
+    # .npz members cannot be mapped, each one is read when it is first asked for.
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        self.archive = None
+        data = np.load(file_path, mmap_mode="r")
+        if isinstance(data, np.lib.npyio.NpzFile):
+            self.archive = data
+            self._channels = list(data.files)
+            return
+        if data.ndim == 2:
+            self.stack = data[np.newaxis]
+            self._channels = [os.path.splitext(os.path.basename(file_path))[0]]
+        elif data.ndim == 3:
+            self.stack = data
+            self._channels = self.stack_channel_names(file_path, len(data))
+        else:
+            raise ValueError(f"expected a 2D image or a (C, H, W) stack, got shape {data.shape}")
+
+    @staticmethod
+    def stack_channel_names(file_path, n_channels):
+        names_path = f"{file_path[:-len('.npy')]}_channels.txt"
+        if os.path.exists(names_path):
+            with open(names_path) as file:
+                names = [line.strip() for line in file if line.strip()]
+            if len(names) == n_channels:
+                return names
+        return [f"channel{i}" for i in range(n_channels)]
+
+    def channels(self, scan_dir=None):
+        return list(self._channels)
+
+    def read(self, channel, scan_dir=None, job=None):
+        if self.archive is not None:
+            return self.archive[channel]
+        return self.stack[self._channels.index(channel)]
+
+    def shape(self, channel, scan_dir=None):
+        if self.archive is None:
+            return self.stack.shape[1:]
+        # Only the .npy header of the member is read
+        with self.archive.zip.open(f"{channel}.npy") as file:
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(file)
+        return shape
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+def open_scan(file_path, lazy=True):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in TDMS_EXTENSIONS:
+        return TdmsReader(file_path, lazy)
+    if extension in NUMPY_EXTENSIONS:
+        return NumpyReader(file_path)
+    # Bruker files carry the scan number as extension (.001, .002...) or .spm
+    return BrukerReader(file_path)
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Bump when extract_parameters changes its results, older entries are then never hit again
+CACHE_VERSION = 1
+CACHE_DIR_ENV = "SELECTOR_CACHE_DIR"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "image_selector", "surfparams")
+DEFAULT_RESULT_CACHE_BYTES = 256 * 1024 ** 2
+
+
+def result_key(area, dx, dy, rect_size, fitted):
+    # Content address of a surface-parameter computation: the region pixels and every argument
+    # of extract_parameters, so the same region gives the same key from any file or session
+    area = np.ascontiguousarray(area)
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_VERSION}|{area.dtype.str}|{area.shape}|{dx!r}|{dy!r}|{rect_size}|{bool(fitted)}".encode())
+    digest.update(memoryview(area).cast("B"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # Surface parameters pickled on disk, one file per key, least recently used entries are
+    # deleted past max_bytes. Files are written atomically so several apps and batch runs can
+    # share the directory, an entry deleted by another process is simply a miss.
+    def __init__(self, directory=None, max_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        self.directory = directory or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizes = OrderedDict()
+        self.lock = threading.RLock()
+        self._scan()
+
+    def _scan(self):
+        # Entries of previous sessions, oldest first
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(".pkl")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self.current_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def __contains__(self, key):
+        return key in self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, key):
+        # The cached result or None, counted as a hit or a miss. Entries written by another
+        # process since this cache was opened are read too, and taken into account from then on.
+        with self.lock:
+            try:
+                with open(self._path(key), "rb") as file:
+                    result = pickle.load(file)
+                # The modification time orders the entries for the next sessions
+                os.utime(self._path(key))
+            except (OSError, pickle.UnpicklingError, EOFError):
+                if key in self._sizes:
+                    self.current_bytes -= self._sizes.pop(key)
+                self.misses += 1
+                return None
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+            else:
+                try:
+                    size = os.path.getsize(self._path(key))
+                except OSError:
+                    size = 0
+                self._sizes[key] = size
+                self.current_bytes += size
+                self._evict()
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(data) > self.max_bytes:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, self._path(key))
+            if key in self._sizes:
+                self.current_bytes -= self._sizes.pop(key)
+            self._sizes[key] = len(data)
+            self.current_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        # Least recently used entries first, down to max_bytes
+        while self.current_bytes > self.max_bytes and self._sizes:
+            evicted, size = self._sizes.popitem(last=False)
+            self.current_bytes -= size
+            try:
+                os.remove(self._path(evicted))
+            except OSError:
+                pass
+
+    def get(self, key, compute):
+        result = self.lookup(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            for key in self._sizes:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._sizes.clear()
+            self.current_bytes = 0
@@ -0,0 +1,128 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from dr_pnas.extraction import extract_parameters
+
+from result_cache import result_key
+from tiling import tile_origins, tile_views
+
+# Physical width of a scan when nothing else is known, same default as the GUI
+DEFAULT_DIMENSIONS_UM = 10
+
+
+def pixel_size(dimensions_um, shape):
+    # nm per pixel, as compute_surf_params: the physical size spread over the image rows
+    return dimensions_um * 1000 / shape[0]
+
+
+def compute_region(area, dx, rect_size, fitted=False):
+    # Runs in the worker processes
+    return extract_parameters(area, dx, dx, rect_size, fitted=fitted)
+
+
+def params_row(region, params):
+    # One table row: the region description then its parameters
+    row = dict(region)
+    for name, value in params.items():
+        value = np.asarray(value)
+        row[str(name)] = value.item() if value.size == 1 else str(value.tolist())
+    return row
+
+
+def cached_parameters(cache, area, dx, rect_size, fitted=False):
+    # extract_parameters on the calling thread, through the result cache when there is one
+    if cache is None:
+        return compute_region(area, dx, rect_size, fitted)
+    key = result_key(area, dx, dx, rect_size, fitted)
+    return cache.get(key, lambda: compute_region(area, dx, rect_size, fitted))
+
+
+def tile_regions(image, region, tile_size, stride=None, overlap=0, edge="drop"):
+    # (region, area) for every tile of a channel image, region holds the file and channel names
+    # Tiles are copied one at a time as they are sent to the pool
+    tiles = tile_views(image, tile_size, stride, overlap, edge)
+    origins = iter(tile_origins(image.shape, tile_size, stride, overlap, edge))
+    for row in tiles:
+        for area in row:
+            x, y = next(origins)
+            yield dict(region, x=x, y=y, size=tile_size), np.ascontiguousarray(area)
+
+
+def coordinate_regions(image, region, coords, size):
+    # (region, area) for the rectangles of a coordinates file (top left corners), out of bounds
+    # ones are skipped like in save_area
+    for x, y in coords:
+        x, y = max(x, 0), max(y, 0)
+        area = image[y:y + size, x:x + size]
+        if area.shape == (size, size):
+            yield dict(region, x=x, y=y, size=size), np.ascontiguousarray(area)
+
+
+def compute_regions(regions, writer, workers=None, job=None, total=0, mp_context=None, on_row=None, cache=None,
+                    fitted=False):
+    # Sends (region, area, dx) to a process pool and writes the rows as they come back, in
+    # completion order. At most a few regions per worker are in flight so a whole dataset of
+    # tiles never sits in memory. Regions found in the cache are written without going through
+    # the pool. Returns (regions done, regions failed, seconds).
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    n_done = n_failed = 0
+
+    def count(ok, message=None):
+        nonlocal n_done, n_failed
+        if ok:
+            n_done += 1
+        else:
+            n_failed += 1
+            if job is not None:
+                job.warn(message)
+            else:
+                print(message)
+        if job is not None:
+            job.report(n_done + n_failed, max(total, n_done + n_failed))
+        if on_row is not None:
+            on_row(n_done, n_failed)
+
+    def collect(futures):
+        for future in futures:
+            region, key = pending.pop(future)
+            try:
+                params = future.result()
+            except Exception as e:
+                count(False, f"Error computing parameters: {e}")
+                continue
+            if cache is not None:
+                cache.put(key, params)
+            writer.write(params_row(region, params))
+            count(True)
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+    # {future: (region, cache key)}
+    pending = {}
+    try:
+        for region, area, dx in regions:
+            if job is not None:
+                job.check_cancelled()
+            key = None
+            if cache is not None:
+                key = result_key(area, dx, dx, area.shape[0], fitted)
+                params = cache.lookup(key)
+                if params is not None:
+                    writer.write(params_row(region, params))
+                    count(True)
+                    continue
+            pending[pool.submit(compute_region, area, dx, area.shape[0], fitted)] = (region, key)
+            if len(pending) >= 4 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        while pending:
+            if job is not None:
+                job.check_cancelled()
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    finally:
+        # A cancelled job leaves the queued regions behind
+        pool.shutdown(wait=True, cancel_futures=True)
+    return n_done, n_failed, time.perf_counter() - start
@@ -0,0 +1,141 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from profiler import PROFILER
+
+TILE_SIZE = 256
+# drop: only tiles that fit in the image, pad: zero padded edge tiles, reflect: mirrored edge tiles
+EDGE_POLICIES = ["drop", "pad", "reflect"]
+
+
+def tile_stride(tile_size, stride=None, overlap=0):
+    # Either an explicit stride or tiles overlapping by `overlap` pixels
+    if stride is None:
+        stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"stride must be positive, got {stride} for {tile_size} px tiles")
+    return stride
+
+
+def axis_origins(length, tile_size, stride, edge):
+    if edge not in EDGE_POLICIES:
+        raise ValueError(f"Unknown edge policy: {edge}")
+    if edge == "drop":
+        return list(range(0, length - tile_size + 1, stride))
+    # Enough tiles to cover the whole axis, the last ones run past the edge
+    n = max(0, -(-(length - tile_size) // stride)) + 1
+    return [i * stride for i in range(n)]
+
+
+def tile_origins(shape, tile_size=TILE_SIZE, stride=None, overlap=0, edge="drop"):
+    # Top left corners [x, y] of the tiles, row by row, from the image shape alone
+    stride = tile_stride(tile_size, stride, overlap)
+    ys = axis_origins(shape[0], tile_size, stride, edge)
+    xs = axis_origins(shape[1], tile_size, stride, edge)
+    return [[x, y] for y in ys for x in xs]
+
+
+def tile_views(image, tile_size=TILE_SIZE, stride=None, overlap=0, edge="drop"):
+    # (tile rows, tile columns, tile_size, tile_size) windows on the image, in the order of
+    # tile_origins. They are views of the image, only edge tiles of "pad" and "reflect" need a
+    # padded copy of it.
+    stride = tile_stride(tile_size, stride, overlap)
+    ys = axis_origins(image.shape[0], tile_size, stride, edge)
+    xs = axis_origins(image.shape[1], tile_size, stride, edge)
+    if not ys or not xs:
+        return np.empty((len(ys), len(xs), tile_size, tile_size), dtype=image.dtype)
+    pad_rows = max(0, ys[-1] + tile_size - image.shape[0])
+    pad_cols = max(0, xs[-1] + tile_size - image.shape[1])
+    if pad_rows or pad_cols:
+        mode = "constant" if edge == "pad" else "reflect"
+        image = np.pad(image, ((0, pad_rows), (0, pad_cols)), mode=mode)
+    windows = sliding_window_view(image, (tile_size, tile_size))
+    return windows[::stride, ::stride][:len(ys), :len(xs)]
+
+
+def save_tiles(directory, file_name, channel, channel_image, tile_size=TILE_SIZE, stride=None, overlap=0,
+               edge="drop"):
+    # One .npy per tile, named like the areas of "Save All". Returns the tile origins for the
+    # coordinates file.
+    tiles = tile_views(channel_image, tile_size, stride, overlap, edge)
+    origins = tile_origins(channel_image.shape, tile_size, stride, overlap, edge)
+    with PROFILER.span("write_npy", tiles.shape[0] * tiles.shape[1] * tile_size ** 2 * channel_image.itemsize):
+        i = 0
+        for row in tiles:
+            for tile in row:
+                np.save(f"{directory}/{file_name}_AREA{i+1}_{channel}_selected_area.npy", tile)
+                i += 1
+    return origins
+
+
+def save_coordinates_file(directory, file_name, coords):
+    file_path = f"{directory}/{file_name}_selected_areas_coordinates.txt"
+    with open(file_path, "w") as file:
+        for pair in coords:
+            file.write(f"{pair[0]}, {pair[1]}\n")
+    return file_path
+
+
+def read_coordinates(file_path):
+    coords = []
+    with open(file_path) as file:
+        for line in file:
+            if line.strip():
+                x, y = line.split(",")
+                coords.append([int(x), int(y)])
+    return coords
+
+
+TILE_STATS = ["mean", "std", "min", "max", "nan_fraction"]
+
+
+def tile_stats(image, tile_size=TILE_SIZE, stride=None, overlap=0, edge="drop"):
+    # Stats of every tile at once, each one a (tile rows, tile columns) array. Side by side tiles
+    # are a reshape of the image, overlapping ones reduce the windows of tile_views. NaN and inf
+    # pixels are left out and counted in nan_fraction.
+    stride = tile_stride(tile_size, stride, overlap)
+    ys = axis_origins(image.shape[0], tile_size, stride, edge)
+    xs = axis_origins(image.shape[1], tile_size, stride, edge)
+    with PROFILER.span("tile_stats", image.nbytes):
+        if stride == tile_size and edge == "drop":
+            rows, cols = len(ys) * tile_size, len(xs) * tile_size
+            tiles = image[:rows, :cols].reshape(len(ys), tile_size, len(xs), tile_size).swapaxes(1, 2)
+        else:
+            tiles = tile_views(image, tile_size, stride, overlap, edge)
+        finite = np.isfinite(tiles)
+        if finite.all():
+            return {
+                "mean": tiles.mean(axis=(2, 3)),
+                "std": tiles.std(axis=(2, 3)),
+                "min": tiles.min(axis=(2, 3)),
+                "max": tiles.max(axis=(2, 3)),
+                "nan_fraction": np.zeros(tiles.shape[:2]),
+            }
+        count = finite.sum(axis=(2, 3))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(finite, tiles, 0).sum(axis=(2, 3)) / count
+            deviation = np.where(finite, tiles - mean[:, :, None, None], 0)
+            std = np.sqrt((deviation ** 2).sum(axis=(2, 3)) / count)
+        empty = count == 0
+        return {
+            "mean": mean,
+            "std": std,
+            "min": np.where(empty, np.nan, np.where(finite, tiles, np.inf).min(axis=(2, 3))),
+            "max": np.where(empty, np.nan, np.where(finite, tiles, -np.inf).max(axis=(2, 3))),
+            "nan_fraction": 1 - count / float(tile_size * tile_size),
+        }
+
+
+def tile_stats_columns(channel_stats):
+    # Long table for write_columns from {channel: (tile origins, tile_stats)}: one row per channel
+    # and tile, origins as in the coordinates file
+    names = ["channel", "x", "y"] + TILE_STATS
+    columns = [[] for _ in names]
+    for channel, (origins, stats) in channel_stats.items():
+        n = len(origins)
+        columns[0].append(np.full(n, channel))
+        columns[1].append(np.array([x for x, _ in origins]))
+        columns[2].append(np.array([y for _, y in origins]))
+        for column, stat in zip(columns[3:], TILE_STATS):
+            column.append(stats[stat].ravel())
+    return names, [np.concatenate(column) if column else np.empty(0) for column in columns]
@@ -10,28 +10,15 @@ import pySPM
 import contextlib
 import re
 import pandas as pd
+from readers import BrukerReader, bruker_channel_names
+# Kept importable from here, they live with the tiling code so the batch tools do not load Tk
+from tiling import read_coordinates, save_coordinates_file
 
 def extract_channel_names_bruker(self, Scan):
-        chans = []
-        for layer in Scan.layers:
-            with contextlib.suppress(KeyError):
-                temp = layer[b"@2:Image Data"][0].decode("latin1")
-                pattern = r'"(.*?)"'
-                match = re.search(pattern, temp)
-                extracted_channel_name = match.group(1)
-                chans.append(extracted_channel_name)
-        return chans
+    return bruker_channel_names(Scan)
 
 def load_bruker(file_path):
-    blend = pySPM.Bruker(file_path)
-    channels = []
-    for layer in blend.layers:
-        with contextlib.suppress(KeyError):
-            temp = layer[b"@2:Image Data"][0].decode("latin1")
-            pattern = r'"(.*?)"'
-            match = re.search(pattern, temp)
-            extracted_channel_name = match.group(1)
-            channels.append(extracted_channel_name)
-    return blend, channels
-
+    # Still a pySPM.Bruker for the callers using get_channel(), the channel names come from the
+    # indexed header
+    return pySPM.Bruker(file_path), BrukerReader(file_path).channels()
 